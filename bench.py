@@ -0,0 +1,347 @@
+"""
+Diff benchmark requires:
+
+- opencv-python
+- imutils
+
+as well as the diffing requirements (see utils.py)
+
+Times utils.perform_diffing, stage by stage, on synthetic screenshot pairs
+that get generated on the fly (so this runs offline, without any browser),
+and compares the results against a stored baseline, so that changes to the
+diff code can be checked for making things slower (or use more memory).
+
+Every case runs in a fresh process, so that its peak RSS is its own. The
+pages are generated from a fixed seed, so every run diffs the exact same
+pixels. Stage times are inclusive: relocation searches happen as part of
+highlighting, and the row alignment calls its own SSIM comparisons.
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import functools
+import statistics
+import multiprocessing
+import tempfile
+
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+import utils
+
+
+# The utils functions that get timed, and the name of their stage.
+STAGES = {
+	'make_same_size': 'size',
+	'align_rows': 'align',
+	'diff_map': 'ssim',
+	'map_regions': 'contours',
+	'collapse_diffs': 'collapse',
+	'highlight_diffs': 'highlight',
+	'locate_origin': 'relocate',
+	'write_thumbnails': 'thumbnails',
+}
+
+PAGE_WIDTH = 1200
+PAGE_HEIGHT = 4000
+TALL_PAGE_HEIGHT = 30000
+SEED = 1234
+
+WORDS = (
+	'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+	'incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud '
+	'exercitation ullamco laboris nisi aliquip ex ea commodo consequat'
+).split()
+
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+LINE_HEIGHT = 28
+
+
+def text_line(rng, count):
+	return ' '.join(rng.choice(WORDS, count))
+
+
+def write_line(img, text, x, y, scale=0.6, color=utils.BLACK):
+	# anti-aliased, like real text in a screenshot
+	cv2.putText(img, text, (x, y), FONT, scale, color, 1, cv2.LINE_AA)
+
+
+def make_page(height, seed=SEED, width=PAGE_WIDTH):
+	"""
+	Generate a page-like image: headings, paragraphs of anti-aliased text,
+	and colored "image" blocks. Returns the page, as well as the (x1, y1,
+	x2, y2) boxes of its text lines and of its image blocks.
+	"""
+	rng = np.random.default_rng(seed)
+	img = np.full((height, width, 3), 255, dtype=np.uint8)
+	lines = []
+	blocks = []
+
+	y = 60
+	while y < height - 200:
+		kind = rng.integers(0, 4)
+		if kind == 0:
+			write_line(img, text_line(rng, 5).title(), 40, y + 30, 1.1)
+			y += 70
+		elif kind == 1:
+			(x1, x2) = sorted(rng.integers(40, width - 40, 2))
+			if x2 - x1 < 200:
+				continue
+			color = tuple(int(c) for c in rng.integers(0, 200, 3))
+			cv2.rectangle(img, (int(x1), y), (int(x2), y + 160), color, cv2.FILLED)
+			blocks.append((int(x1), y, int(x2), y + 160))
+			y += 200
+		else:
+			for _ in range(rng.integers(3, 9)):
+				write_line(img, text_line(rng, 14), 40, y + 20)
+				lines.append((40, y, width - 40, y + LINE_HEIGHT))
+				y += LINE_HEIGHT
+			y += 24
+
+	return img, lines, blocks
+
+
+def change_text(page, lines, rng):
+	"""
+	Rewrite a single line of text somewhere in the bottom half of the page.
+	"""
+	b = page.copy()
+	(x1, y1, x2, y2) = lines[len(lines) // 2 + rng.integers(0, len(lines) // 2)]
+	b[y1:y2, x1:x2] = 255
+	write_line(b, text_line(rng, 14), x1, y1 + 20)
+	return b
+
+
+def insert_banner(page, rng, y=400, height=120):
+	"""
+	Insert a banner, pushing everything below it down.
+	"""
+	banner = np.full((height, page.shape[1], 3), (40, 90, 200), dtype=np.uint8)
+	write_line(banner, text_line(rng, 6), 40, height // 2, 1.0, utils.WHITE)
+	return np.vstack([page[:y], banner, page[y:]])
+
+
+def move_block(page, blocks):
+	"""
+	Move the first image block to the other side of the page.
+	"""
+	b = page.copy()
+	(x1, y1, x2, y2) = blocks[0]
+	width = x2 - x1
+	target = 40 if x1 > page.shape[1] // 2 else page.shape[1] - 40 - width
+	content = b[y1:y2, x1:x2].copy()
+	b[y1:y2, x1:x2] = 255
+	b[y1:y2, target:target + width] = content
+	return b
+
+
+def antialias_noise(page, rng):
+	"""
+	Nudge the anti-aliased edge pixels by a few levels, like two renders of
+	the same page on slightly different graphics stacks would.
+	"""
+	b = page.copy()
+	edges = cv2.Canny(cv2.cvtColor(page, cv2.COLOR_BGR2GRAY), 50, 150) > 0
+	noise = rng.integers(-3, 4, (int(edges.sum()), 3))
+	b[edges] = np.clip(b[edges].astype(np.int16) + noise, 0, 255).astype(np.uint8)
+	return b
+
+
+def make_case(name):
+	"""
+	Generate the image pair for a case, along with the perform_diffing
+	options it should be diffed with.
+	"""
+	rng = np.random.default_rng(SEED + 1)
+	tall = name.startswith('tall')
+	(a, lines, blocks) = make_page(TALL_PAGE_HEIGHT if tall else PAGE_HEIGHT)
+
+	if name == 'identical':
+		return (a, a.copy()), {}
+	if name in ['text', 'tall-text']:
+		return (a, change_text(a, lines, rng)), {}
+	if name == 'banner':
+		return (a, insert_banner(a, rng)), { 'align': False }
+	if name in ['banner-aligned', 'tall-banner-aligned']:
+		return (a, insert_banner(a, rng)), { 'align': True }
+	if name == 'moved':
+		return (a, move_block(a, blocks)), {}
+	if name == 'noise':
+		return (a, antialias_noise(a, rng)), {}
+	if name == 'tall-text-tiled':
+		return (a, change_text(a, lines, rng)), { 'tile_height': 512 }
+	raise ValueError(f'unknown case {name}')
+
+
+CASES = [
+	'identical',
+	'text',
+	'banner',
+	'banner-aligned',
+	'moved',
+	'noise',
+	'tall-text',
+	'tall-text-tiled',
+	'tall-banner-aligned',
+]
+
+
+def time_stages(timings):
+	"""
+	Wrap the utils functions listed in STAGES, adding the time spent in
+	them to the timings dict. Calls between utils functions go through
+	the module globals, so those get timed as well.
+	"""
+	def timed(stage, fn):
+		@functools.wraps(fn)
+		def wrapper(*args, **kwargs):
+			start = time.perf_counter()
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+		return wrapper
+
+	for (name, stage) in STAGES.items():
+		setattr(utils, name, timed(stage, getattr(utils, name)))
+
+
+def peak_rss_mb():
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# linux reports kilobytes, macos reports bytes.
+	return peak / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_case(name, repeat):
+	"""
+	Generate and diff a case [repeat] times, returning the median time for
+	every stage, the median total time, the process' peak RSS, and what the
+	diff found. This runs in its own process.
+	"""
+	(pair, options) = make_case(name)
+	timings = {}
+	time_stages(timings)
+
+	runs = []
+	with tempfile.TemporaryDirectory() as result_path:
+		for _ in range(repeat):
+			timings.clear()
+			start = time.perf_counter()
+			(a, b) = utils.make_same_size(*pair, same_height=options.get('align', False) is False)
+			result = utils.perform_diffing((a, b), True, result_path, True, silent=True, **options)
+			timings['total'] = time.perf_counter() - start
+			runs.append(dict(timings))
+
+	stages = sorted(set(stage for run in runs for stage in run) - {'total'})
+	return {
+		'stages': { stage: statistics.median(run.get(stage, 0.0) for run in runs) for stage in stages },
+		'total': statistics.median(run['total'] for run in runs),
+		'peak_rss_mb': round(peak_rss_mb(), 1),
+		'diffs': len(result['diffs']) + len(result['removed']),
+		'passed': result['passed'],
+	}
+
+
+def run_benchmarks(cases, repeat):
+	results = {}
+	context = multiprocessing.get_context('spawn')
+	for name in cases:
+		print(f'Running {name}...')
+		with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+			results[name] = executor.submit(run_case, name, repeat).result()
+	return results
+
+
+def compare_results(results, baseline, tolerance, min_time):
+	"""
+	Compare benchmark results against a baseline, returning a list of
+	regressions: stages (or totals) that got slower by more than the given
+	fraction and by more than min_time seconds, peak memory use that grew by
+	more than the given fraction, and cases whose diffs are no longer the same.
+	"""
+	regressions = []
+	for (name, result) in results.items():
+		before = baseline.get(name)
+		if before is None:
+			continue
+
+		times = dict(result['stages'], total=result['total'])
+		old_times = dict(before['stages'], total=before['total'])
+		for (stage, seconds) in times.items():
+			old = old_times.get(stage)
+			if old is not None and seconds > old * (1 + tolerance) and seconds - old > min_time:
+				regressions.append(f'{name}: {stage} took {seconds:.3f}s, up from {old:.3f}s')
+
+		if result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance):
+			regressions.append(f'{name}: peak RSS was {result["peak_rss_mb"]}MB, up from {before["peak_rss_mb"]}MB')
+
+		if (result['diffs'], result['passed']) != (before['diffs'], before['passed']):
+			regressions.append(f'{name}: found {result["diffs"]} differences (passed={result["passed"]}), rather than {before["diffs"]} (passed={before["passed"]})')
+
+	return regressions
+
+
+def log_results(results, baseline):
+	stages = list(dict.fromkeys(STAGES.values())) + ['total']
+	print('')
+	print(f'{"case":<22}' + ''.join(f'{stage:>11}' for stage in stages) + f'{"rss (MB)":>10}')
+	for (name, result) in results.items():
+		times = dict(result['stages'], total=result['total'])
+		print(f'{name:<22}' + ''.join(f'{times[stage]:>11.3f}' if stage in times else f'{"-":>11}' for stage in stages) + f'{result["peak_rss_mb"]:>10}')
+		before = baseline.get(name)
+		if before is not None:
+			old_times = dict(before['stages'], total=before['total'])
+			print(f'{"  (baseline)":<22}' + ''.join(f'{old_times[stage]:>11.3f}' if stage in old_times else f'{"-":>11}' for stage in stages) + f'{before["peak_rss_mb"]:>10}')
+	print('')
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the diff pipeline on synthetic screenshot pairs, and compare against a baseline.')
+	parser.add_argument('cases', nargs='*', default=CASES, help=f'The cases to run. defaults to all of them: {", ".join(CASES)}.')
+	parser.add_argument('-b', '--baseline', default='benchmark.json', help='The baseline file to compare against. defaults to benchmark.json.')
+	parser.add_argument('-m', '--min-time', type=float, default=0.01, help='Ignore slowdowns of less than this many seconds. defaults to 0.01.')
+	parser.add_argument('-r', '--repeat', type=int, default=3, help='How many times to diff each case, using the median times. defaults to 3.')
+	parser.add_argument('-s', '--save', action='store_true', help='Save the results as the new baseline.')
+	parser.add_argument('-t', '--tolerance', type=float, default=0.2, help='How much slower (or bigger) than the baseline counts as a regression, as a fraction. defaults to 0.2.')
+	args = parser.parse_args()
+
+	unknown = [name for name in args.cases if name not in CASES]
+	if len(unknown) > 0:
+		parser.error(f'unknown cases: {", ".join(unknown)}')
+
+	baseline = {}
+	if os.path.exists(args.baseline):
+		with open(args.baseline, 'r') as file:
+			baseline = json.load(file).get('cases', {})
+
+	results = run_benchmarks(args.cases, args.repeat)
+	log_results(results, baseline)
+
+	if args.save:
+		saved = dict(baseline, **results)
+		with open(args.baseline, 'w') as file:
+			json.dump({
+				'machine': {
+					'platform': platform.platform(),
+					'python': platform.python_version(),
+					'numpy': np.__version__,
+					'opencv': cv2.__version__,
+					'cpus': os.cpu_count(),
+				},
+				'cases': saved,
+			}, file, indent=2, sort_keys=True)
+		print(f'Saved the results as the baseline in {args.baseline}.')
+		sys.exit(0)
+
+	regressions = compare_results(results, baseline, args.tolerance, args.min_time)
+	for regression in regressions:
+		print(f'- {regression}')
+	print(f'{len(regressions)} regressions found.' if len(baseline) > 0 else 'No baseline to compare against, use --save to create one.')
+	sys.exit(len(regressions))
@@ -0,0 +1,119 @@
+"""
+Ground truth cache requires:
+
+- opencv-python
+
+Ground truth screenshots only change on --update, so rather than decoding
+each baseline PNG (and computing its gray/hue planes and row hashes) on
+every compare run, we keep a sidecar dir next to each screenshot.png with
+all of those stored as .npy files, which get memory-mapped when diffing.
+
+Each cache entry is keyed on the content hash of the PNG it was built from,
+so a stale entry is simply ignored (and rebuilt). Entries get their key file
+touched whenever they are used, so that the least recently used entries can
+be evicted once the cache grows beyond its disk budget.
+"""
+
+import os
+import shutil
+import hashlib
+
+import numpy as np
+
+import utils
+
+
+CACHE_DIR = 'screenshot.cache'
+KEY_FILE = 'key'
+ARRAYS = ['pixels', 'planes', 'rows']
+
+
+def cache_dir(image_path):
+	return os.path.join(os.path.dirname(image_path), CACHE_DIR)
+
+
+def file_hash(path):
+	"""
+	Hash the content of a (PNG) file.
+	"""
+	h = hashlib.blake2b(digest_size=16)
+	with open(path, 'rb') as file:
+		for chunk in iter(lambda: file.read(1 << 20), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def build(image_path, image=None):
+	"""
+	(Re)build the cache entry for a screenshot, decoding it unless the
+	decoded image is passed in. The key gets written last, so that an
+	interrupted build never yields an entry that looks valid.
+	"""
+	key = file_hash(image_path)
+	image = utils.loadImage(image_path) if image is None else image
+
+	dir = cache_dir(image_path)
+	shutil.rmtree(dir, ignore_errors=True)
+	os.makedirs(dir)
+
+	np.save(os.path.join(dir, 'pixels.npy'), image)
+	np.save(os.path.join(dir, 'planes.npy'), utils.gray_and_hue(image))
+	np.save(os.path.join(dir, 'rows.npy'), np.array(utils.row_hashes(image), dtype=np.uint64))
+
+	with open(os.path.join(dir, KEY_FILE), 'w') as key_file:
+		key_file.write(key)
+
+
+def load(image_path):
+	"""
+	Memory-map the cached pixels, gray/hue planes and row hashes for a
+	screenshot, or return None if there is no (up to date) cache entry.
+	"""
+	dir = cache_dir(image_path)
+	key_path = os.path.join(dir, KEY_FILE)
+	if os.path.exists(key_path) is False:
+		return None
+
+	with open(key_path, 'r') as key_file:
+		if key_file.read() != file_hash(image_path):
+			return None
+
+	try:
+		(pixels, planes, rows) = [
+			np.load(os.path.join(dir, f'{name}.npy'), mmap_mode='r')
+			for name in ARRAYS
+		]
+	except (OSError, ValueError):
+		return None
+
+	# mark this entry as recently used
+	os.utime(key_path)
+	return (pixels, planes, rows.tolist())
+
+
+def entry_size(dir):
+	return sum(entry.stat().st_size for entry in os.scandir(dir) if entry.is_file())
+
+
+def enforce_budget(root, budget):
+	"""
+	Evict the least recently used cache entries under the root dir
+	until the cache takes up no more than [budget] bytes of disk.
+	"""
+	entries = []
+	for (dir, dirs, files) in os.walk(root):
+		if os.path.basename(dir) != CACHE_DIR:
+			continue
+		dirs.clear()
+		key_path = os.path.join(dir, KEY_FILE)
+		last_used = os.stat(key_path).st_mtime if os.path.exists(key_path) else 0
+		entries.append((last_used, entry_size(dir), dir))
+
+	total = sum(size for (_, size, _) in entries)
+	for (_, size, dir) in sorted(entries):
+		if total <= budget:
+			break
+		shutil.rmtree(dir, ignore_errors=True)
+		total -= size
+
+	return total
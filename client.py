@@ -0,0 +1,58 @@
+"""
+A thin client for serve.py: hands its compare.py arguments to a running
+server, prints each failure as the server finds it, and exits with the
+number of failures, just like running compare.py itself would.
+
+This only uses the standard library, so that starting it costs next to
+nothing compared to starting compare.py.
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+import tempfile
+
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), 'ci-image-diff.sock')
+
+
+def send_job(socket_path, argv, cwd):
+	"""
+	Send a job to the server, yielding the messages it sends back.
+	"""
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+		connection.connect(socket_path)
+		job = { 'argv': argv, 'cwd': cwd }
+		connection.sendall((json.dumps(job) + '\n').encode())
+		with connection.makefile('r') as messages:
+			for line in messages:
+				yield json.loads(line)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description='Run a compare.py job on a running serve.py server. All arguments other than the ones below get passed on to compare.py.',
+		allow_abbrev=False
+	)
+	parser.add_argument('--socket', default=DEFAULT_SOCKET, help=f'The server socket. Defaults to {DEFAULT_SOCKET}.')
+	(args, argv) = parser.parse_known_args()
+
+	failures = 0
+	try:
+		for message in send_job(args.socket, argv, os.getcwd()):
+			if 'error' in message:
+				print(message['error'], file=sys.stderr)
+				sys.exit(2)
+			if 'failure' in message:
+				entry = message['failure']
+				path = entry if isinstance(entry, str) else entry['path']
+				print(f'- {path} ({message["key"]}): differences found.')
+			if 'report' in message:
+				failures = message['failures']
+	except (ConnectionRefusedError, FileNotFoundError):
+		print(f'Could not connect to a server at {args.socket}, is serve.py running?', file=sys.stderr)
+		sys.exit(2)
+
+	# exit statuses wrap around past 255, and 256 failures shouldn't pass.
+	sys.exit(min(failures, 255))
@@ -4,6 +4,7 @@ Compare script requires:
 - argparse
 - playwright
 
+as well as the diff engine requirements (see engine.py)
 """
 
 import os
@@ -11,63 +12,148 @@ import re
 import sys
 import json
 import time
-import math
+import hashlib
 import argparse
 import asyncio
 
 from pathlib import Path
-from shutil import copyfile
-from distutils.dir_util import copy_tree
+from shutil import copy2
 from playwright.async_api import async_playwright
 
-parser = argparse.ArgumentParser(description='Create diff sets for web pages, and view those difference in the browser.')
+import cache
+import shard
+import tracing
+from concurrency import AdaptiveLimit, Controller
+from engine import DiffEngine, HashManifest
+from fingerprint import FingerprintManifest, ResourceLog, fingerprint
+from network import NetworkStore
+
+parser = argparse.ArgumentParser(prog='compare.py', description='Create diff sets for web pages, and view those difference in the browser.')
 parser.add_argument('url', nargs='?', help='The URL for the web page.')
 parser.add_argument('-a', '--allow-animations', action='store_true', help='Allow CSS animations. This will almost certainly yield false positives.')
+parser.add_argument('-al', '--align', action='store_true', help='Align the rows of both screenshots before diffing, so that inserted or removed content does not flag everything below it.')
+parser.add_argument('-aq', '--adaptive-queue', action='store_true', help='Keep adjusting how many captures (up to the queue size) and diffs (up to twice the number of diff workers) are in flight, based on available memory, CPU use, and how long captures take. Starts at --min-queue-size.')
 parser.add_argument('-b', '--base-dir', default='diffs', help='Directory for diffs. Defaults to diffs.')
+parser.add_argument('-bx', '--boxes', action='store_true', help='Record the diff regions for each failure in diffs.json, for the viewer to draw, rather than writing full-page mask images.')
 parser.add_argument('-c', '--compare', default='compare', help='Save screenshots to the indicated dir. Defaults to compare.')
+parser.add_argument('-cl', '--clusters', action='store_true', help='Group identical diff regions (the same before and after pixels) across all pages, so that relocation searches only happen once per group, and list the groups in diffs.json as clusters.')
 parser.add_argument('-co', '--compare-only', action='store_true', help='Do not (re)fetch screenshots.')
+parser.add_argument('-dw', '--diff-workers', type=int, default=os.cpu_count(), help='Sets the number of diff worker processes. Defaults to the number of CPUs.')
 parser.add_argument('-d', '--page-delay', type=int, default=1000, help='Graceperiod in milliseconds before taking a screenshot after page is stable. Defaults to 1000.')
+parser.add_argument('-ga', '--gate-area', type=int, default=1, help='When gating, fail screenshots whose differences cover at least this many pixels. Defaults to 1.')
+parser.add_argument('-gs', '--gate-score', type=float, default=0.99, help='When gating, fail screenshots with an SSIM score below this right away, without looking at their differences. Defaults to 0.99.')
+parser.add_argument('-gt', '--gate', action='store_true', help='Only decide whether each screenshot passes, as quickly as possible, without collapsing, relocating or highlighting differences. See --gate-score and --gate-area.')
+parser.add_argument('-gc', '--ground-truth-cache', type=int, default=0, help='Cache the decoded ground truth screenshots on disk, using up to this many megabytes. Defaults to 0 (no cache).')
 parser.add_argument('-g', '--ground-truth', default='main', help='Set the ground truth dir. Defaults to main.')
 parser.add_argument('-i', '--stability-interval', type=int, default=1000, help='Set the "is DOM stable?" test interval in milliseconds. Defaults to 1000.')
+parser.add_argument('-in', '--incremental', action='store_true', help='Skip the screenshot and diff for pages whose DOM and loaded resources are the same as when the ground truth was captured, reporting these as unchanged.')
+parser.add_argument('-is', '--stability-mode', choices=['dom', 'screenshot'], default='dom', help='Decide whether a page is stable by polling its DOM, or by comparing viewport screenshots (which also catches CSS and canvas changes). Defaults to dom.')
+parser.add_argument('-im', '--in-memory', action='store_true', help='Hand screenshots straight to the diff workers without writing them to disk first, only saving the ones that differ to the result dir. Implies --stream.')
 parser.add_argument('-l', '--list', help='Read list of URLs to test from a plain text, newline delimited file.')
+parser.add_argument('-mf', '--max-failures', type=int, default=0, help='Stop capturing and comparing once this many failures have been found. Defaults to 0 (no limit).')
 parser.add_argument('-m', '--missing-error', action='store_true', help='Treat missing ground truth screenshot as error.')
 parser.add_argument('-o', '--match-origin', action='store_true', help='Try to detect relocated content when analysing diffs.')
 parser.add_argument('-p', '--log-path-only', action='store_true', help='Only log which path is being compared, rather than image locations.')
-parser.add_argument('-q', '--queue-size', type=int, default=10, help='Sets the number of concurrent network requests in the batch queue. Defaults to 10')
+parser.add_argument('-pw', '--parallel-widths', action='store_true', help='Capture all widths for a URL at the same time, using one page per width, rather than resizing a single page for each width in turn.')
+parser.add_argument('-q', '--queue-size', type=int, default=10, help='Sets the number of captures that are in flight at any one time. Defaults to 10')
+parser.add_argument('-qc', '--chromium-queue-size', type=int, help='Sets the number of chromium captures that are in flight at any one time. Defaults to the queue size.')
+parser.add_argument('-qn', '--min-queue-size', type=int, default=2, help='The minimum number of captures in flight when using --adaptive-queue. Defaults to 2.')
+parser.add_argument('-qf', '--firefox-queue-size', type=int, help='Sets the number of firefox captures that are in flight at any one time. Defaults to the queue size.')
+parser.add_argument('-rc', '--record', action='store_true', help='Record all network responses during capture, so that later runs can --replay them.')
+parser.add_argument('-rp', '--replay', action='store_true', help='Serve all network requests during capture from what was recorded with --record, without using the network.')
 parser.add_argument('-r', '--result-dir', default='results', help='Directory for comparison results. Defaults to results.')
+parser.add_argument('-sb', '--search-band', type=int, default=0, help='When detecting relocated content, only search this many pixels above and below each diff. Defaults to 0 (search the whole page).')
+parser.add_argument('-sh', '--shard', help='Only run shard i of N (written as i/N) of all url, browser and width combinations, balanced using past capture timings. Use merge.py to combine the shard reports.')
+parser.add_argument('-s', '--stream', action='store_true', help='Diff each screenshot as soon as it has been captured, rather than after all captures have finished.')
+parser.add_argument('-tn', '--thumbnails', action='store_true', help='Write page thumbnails and cropped before/after snippets of each diff region, so the viewer only loads full-page screenshots on request.')
+parser.add_argument('-tr', '--trace', action='store_true', help='Record how long every stage of every capture and diff took, writing a trace.json (for chrome://tracing or ui.perfetto.dev) and a trace-summary.txt to the result dir.')
+parser.add_argument('-th', '--tile-height', type=int, default=0, help='Only run SSIM on the horizontal bands of this height that changed, to keep memory use down on long pages. Defaults to 0 (compare the whole page).')
 parser.add_argument('-u', '--update', action='store_true', help='Update the ground truth screenshots.')
 parser.add_argument('-v', '--verbose', action='store_true', help='Log progress to stdout.')
 parser.add_argument('-vx', '--verbose-exclusive', action='store_true', help='Log progress, but skip logging of each diff process.')
 parser.add_argument('-w', '--width', type=str, default='1200', help='The browser width in pixels. This can be a comma-separated list of multiple widths. Defaults to 1200.')
 parser.add_argument('-z', '--server-hint', action='store_true', help='Print the diff viewer instructions at the end of the run.')
-args = parser.parse_args()
+args = None
 
-# Make sure all width(s) are numbers
-page_widths = args.width
-page_widths = page_widths.split(',') if ',' in page_widths else [page_widths]
-page_widths = [int(v) for v in page_widths]
+# the parsed --shard, see shard.parse
+shard_spec = None
 
-# Form the list of URLs we need to gather screenshots for
+# the widths to capture, and the URLs we need to gather screenshots for
+page_widths = []
 url_stripper = re.compile(r"https?://(www\.)?")
 url_list = []
-if args.list:
-    data = open(args.list, 'r')
-    for line in data:
-        url_list.append(line.strip())
-else:
-    url_list.append(args.url)
 
 # Which directory are we writing files to?
-screenshot_base_dir = args.ground_truth if args.update else args.compare
+screenshot_base_dir = None
 
 # master list of open browsers, for closing once done
 open_browsers = []
 
-# how verbose are we?
-if args.verbose_exclusive:
-    args.verbose = True
+# browsers that stay open across runs, by browser name (see serve.py)
+warm_browsers = {}
+
+# per-width capture timings, see record_width_timing
+width_timings = []
+
+# the (url path, browser, width) jobs for this shard, or None for "all of them"
+assigned_jobs = None
+
+# called with the report key and entry for every failure, if set (see serve.py)
+result_listener = None
+
+LOG_VERBOSE = False
+
+
+def configure(argv=None):
+    """
+    Parse the command line arguments, and set up everything that depends
+    on them. This can be called more than once, by a long-lived process
+    (see serve.py) that runs one compare job after another.
+    """
+    global args, shard_spec, page_widths, url_list, screenshot_base_dir, LOG_VERBOSE
+
+    args = parser.parse_args(argv)
+
+    if args.diff_workers < 1:
+        parser.error('--diff-workers must be at least 1')
+
+    if args.min_queue_size < 1 or args.min_queue_size > args.queue_size:
+        parser.error('--min-queue-size must be between 1 and the queue size')
+
+    if args.record and args.replay:
+        parser.error('--record and --replay cannot be used together')
+
+    shard_spec = None
+    if args.shard is not None:
+        try:
+            shard_spec = shard.parse(args.shard)
+        except ValueError as e:
+            parser.error(f'--shard: {e}')
+
+    # Make sure all width(s) are numbers
+    page_widths = args.width
+    page_widths = page_widths.split(',') if ',' in page_widths else [page_widths]
+    page_widths = [int(v) for v in page_widths]
+
+    # Form the list of URLs we need to gather screenshots for
+    url_list = []
+    if args.list:
+        data = open(args.list, 'r')
+        for line in data:
+            url_list.append(line.strip())
+    else:
+        url_list.append(args.url)
+
+    screenshot_base_dir = args.ground_truth if args.update else args.compare
+
+    # how verbose are we?
+    if args.verbose_exclusive:
+        args.verbose = True
+
+    LOG_VERBOSE = args.verbose
+
+    reset_run_state()
 
-LOG_VERBOSE = args.verbose
 
 def log_info(*args):
 	if LOG_VERBOSE is False:
@@ -78,10 +164,45 @@ def path_safe(str):
     return str.replace(':', '-').replace('@','-')
 
 
+IMAGES_LOADED = '(imgs) => Array.from(imgs).every(img => img.complete)'
+
+async def screenshot_is_stable(page):
+    """
+    Consider the page stable once two consecutive (low quality) viewport
+    captures are identical and all images have loaded. We start polling
+    quickly, and back off towards --stability-interval for as long as the
+    page keeps changing, giving up after the same amount of time that ten
+    DOM polling attempts would take. See https://github.com/MozillaFoundation/ci-image-diff/issues/21
+    """
+    interval = min(100, args.stability_interval)
+    deadline = time.monotonic() + 10 * args.stability_interval / 1000
+    previous_frame = None
+
+    while True:
+        frame = hashlib.blake2b(await page.screenshot(type='jpeg', quality=20)).digest()
+
+        if frame == previous_frame:
+            loaded = await page.eval_on_selector_all('img', IMAGES_LOADED)
+            if loaded is True:
+                return True
+
+        if time.monotonic() >= deadline:
+            # Page has *not* stabilised but we've run out of time.
+            return False
+
+        previous_frame = frame
+        await asyncio.sleep(interval / 1000)
+        interval = min(2 * interval, args.stability_interval)
+
+
 async def content_is_stable(page):
     """
-    Ideally we do this using screenshots, see https://github.com/MozillaFoundation/ci-image-diff/issues/21
+    Poll the page until its DOM stops changing, unless we're
+    using screenshot-based stability detection.
     """
+    if args.stability_mode == 'screenshot':
+        return await screenshot_is_stable(page)
+
     attempt = 0
     previous_html = ''
 
@@ -92,8 +213,7 @@ async def content_is_stable(page):
         inner_html = await html.inner_html()
 
         if inner_html == previous_html:
-            js = '(imgs) => Array.from(imgs).every(img => img.complete)'
-            loaded = await page.eval_on_selector_all('img', js)
+            loaded = await page.eval_on_selector_all('img', IMAGES_LOADED)
             if loaded is True:
                 return True
 
@@ -104,70 +224,205 @@ async def content_is_stable(page):
     return False
 
 
-async def deferred_capture_screenshot_for_url(browser, browser_type, url_path, page_url, page_widths):
-    browser_name = browser_type.name
+async def open_page(target):
+    """
+    Open a new page in a browser (or browser context), with the network
+    store attached to it when recording or replaying.
+    """
+    page = await target.new_page()
+    if network_store is not None:
+        await network_store.attach(page, replay=args.replay)
+    return page
 
-    log_info(f'Navigating to {page_url} using {browser_name}')
-    page = await browser.new_page()
-    await page.goto(page_url)
 
-    for page_width in page_widths:
-        # Set the viewport size it to the correct width, and navigate to the URL we want to capture.
-        await page.set_viewport_size({ 'width': page_width, 'height': 800 })
+async def close_page(page):
+    """
+    Close a page, once the network store is done recording its responses.
+    """
+    if network_store is not None:
+        await network_store.settle()
+    await page.close()
+
+
+def watch_resources(page):
+    """
+    Keep track of what a page loads, if we need to fingerprint it.
+    """
+    if fingerprints is None:
+        return None
+    return ResourceLog().attach(page)
+
+
+async def capture_width(page, browser_name, url_path, page_url, page_width, diff_queue=None, resources=None):
+    """
+    Take the screenshot for a single width, on a page that has already
+    navigated to the URL we want to capture, returning how long it took
+    for the page to stabilise, and how long the screenshot itself took.
+    When fingerprinting, the screenshot gets skipped if the page is
+    unchanged compared to when its ground truth was captured.
+    """
+    started = time.monotonic()
+
+    # disable CSS animations, unless explicitly told not to. This happens
+    # before waiting for the page to settle, because a page with an endless
+    # animation never looks the same twice, in --stability-mode screenshot.
+    if not args.allow_animations:
+        await page.eval_on_selector('head', '''
+        (head) => {
+            const noAnimation = document.createElement(`style`);
+            noAnimation.textContent = `* { animation: none!important; }`;
+            head.append(noAnimation);
+        }
+        ''')
+
+    # Set the viewport size it to the correct width, and wait for the page to settle.
+    await page.set_viewport_size({ 'width': page_width, 'height': 800 })
+    with tracing.span('stabilise', 'capture', url=page_url, browser=browser_name, width=page_width):
         await content_is_stable(page)
+    with tracing.span('page delay', 'capture', url=page_url, browser=browser_name, width=page_width):
         await page.wait_for_timeout(args.page_delay)
 
-        # disable CSS animations, unless explicitly told not to.
-        if not args.allow_animations:
-            await page.eval_on_selector('head', '''
-            (head) => {
-                const noAnimation = document.createElement(`style`);
-                noAnimation.textContent = `* { animation: none!important; }`;
-                head.append(noAnimation);
-            }
-            ''')
-
-        log_info(f'- [{browser_name}] Taking screenshot at size {page_width} ({page_url})')
+    stabilised = time.monotonic()
+
+    if resources is not None:
+        key = shard.job_key(url_path, browser_name, page_width)
+        with tracing.span('fingerprint', 'capture', url=page_url, browser=browser_name, width=page_width):
+            current = await fingerprint(page, resources)
+        if args.update:
+            fingerprints.set(key, current)
+        elif fingerprints.get(key) == current:
+            log_info(f'- [{browser_name}] {page_url} is unchanged at size {page_width}, skipping screenshot')
+            unchanged_jobs.add((browser_name, page_width, url_path))
+            return { 'stable': stabilised - started, 'screenshot': 0 }
+
+    log_info(f'- [{browser_name}] Taking screenshot at size {page_width} ({page_url})')
+
+    # When diffing in memory, the screenshot goes straight to the
+    # diff engine, and only gets written out if it differs.
+    if diff_queue is not None and args.in_memory:
+        with tracing.span('screenshot', 'capture', url=page_url, browser=browser_name, width=page_width):
+            screenshot = await page.screenshot(full_page=True)
+        captured = time.monotonic()
+        await diff_queue.put((browser_name, page_width, url_path, screenshot))
 
+    else:
         # Figure out which path we need to write to, and ensure the dir for that exists.
-        parent = f'./diffs/{screenshot_base_dir}/{browser_name}-{page_width}/{url_path}'
+        parent = f'./{args.base_dir}/{screenshot_base_dir}/{browser_name}-{page_width}/{url_path}'
         Path(parent).mkdir(parents=True, exist_ok=True)
         image_path = f'{parent}/screenshot.png'
 
         # log_info(f'Creating {image_path}')
-        await page.screenshot(path=image_path, full_page=True)
+        with tracing.span('screenshot', 'capture', url=page_url, browser=browser_name, width=page_width):
+            await page.screenshot(path=image_path, full_page=True)
+        captured = time.monotonic()
 
-    await page.close()
+        # when streaming, this screenshot can be diffed right away.
+        if diff_queue is not None:
+            await diff_queue.put((browser_name, page_width, url_path, None))
+
+    return { 'stable': stabilised - started, 'screenshot': captured - stabilised }
+
+
+def record_width_timing(browser_name, url_path, page_url, page_width, navigate, timing):
+    timing = dict(timing, browser=browser_name, path=url_path, url=page_url, width=page_width, navigate=navigate)
+    width_timings.append(timing)
+    log_info(f'  [{browser_name}] {page_url} at {page_width}px: navigated in {navigate:.1f}s, stabilised in {timing["stable"]:.1f}s, captured in {timing["screenshot"]:.1f}s')
+
+
+async def deferred_capture_screenshot_for_url(browser, browser_type, url_path, page_url, page_widths, diff_queue=None):
+    browser_name = browser_type.name
+
+    if args.parallel_widths and len(page_widths) > 1:
+        return await parallel_capture_screenshot_for_url(browser, browser_name, url_path, page_url, page_widths, diff_queue)
 
+    log_info(f'Navigating to {page_url} using {browser_name}')
+    started = time.monotonic()
+    with tracing.span('navigate', 'capture', url=page_url, browser=browser_name):
+        page = await open_page(browser)
+        resources = watch_resources(page)
+        await page.goto(page_url)
+    navigate = time.monotonic() - started
+
+    for page_width in page_widths:
+        timing = await capture_width(page, browser_name, url_path, page_url, page_width, diff_queue, resources)
+        record_width_timing(browser_name, url_path, page_url, page_width, navigate, timing)
+        # later widths reuse the already loaded page
+        navigate = 0
+
+    await close_page(page)
+
+
+async def parallel_capture_screenshot_for_url(browser, browser_name, url_path, page_url, page_widths, diff_queue=None):
+    """
+    Capture all widths at the same time, using a page per width. These all
+    live in the same browser context, and the first page gets to navigate
+    before the others do, so that they can load from its HTTP cache.
+    """
+    log_info(f'Navigating to {page_url} using {browser_name} at {len(page_widths)} widths')
+    context = await browser.new_context()
+
+    async def open_width(page_width):
+        started = time.monotonic()
+        with tracing.span('navigate', 'capture', url=page_url, browser=browser_name, width=page_width):
+            page = await open_page(context)
+            resources = watch_resources(page)
+            await page.set_viewport_size({ 'width': page_width, 'height': 800 })
+            await page.goto(page_url)
+        return (page, resources, time.monotonic() - started)
+
+    async def capture(page_width, opened=None):
+        (page, resources, navigate) = opened or await open_width(page_width)
+        timing = await capture_width(page, browser_name, url_path, page_url, page_width, diff_queue, resources)
+        record_width_timing(browser_name, url_path, page_url, page_width, navigate, timing)
+        await close_page(page)
+
+    try:
+        first = await open_width(page_widths[0])
+        await asyncio.gather(
+            capture(page_widths[0], first),
+            *[capture(page_width) for page_width in page_widths[1:]]
+        )
+    finally:
+        await context.close()
 
-async def capture_screenshot_for_url(browser, browser_type, page_widths, url_path, page_url):
+
+async def capture_screenshot_for_url(browser, browser_type, page_widths, url_path, page_url, diff_queue=None):
     return [
-        lambda:
+        (browser_type.name, page_url, lambda:
             deferred_capture_screenshot_for_url(
                 browser,
                 browser_type,
                 url_path,
                 page_url,
-                page_widths
+                page_widths,
+                diff_queue
             )
+        )
     ]
 
 
-async def capture_screenshots_for(browser_type, page_widths, urls, url_paths):
+async def capture_screenshots_for(browser_type, page_widths, urls, url_paths, diff_queue=None):
     browser_name = browser_type.name
-    browser = await browser_type.launch(headless=True)
-    open_browsers.append(browser)
+    browser = warm_browsers.get(browser_name)
+    if browser is None:
+        browser = await browser_type.launch(headless=True)
+        open_browsers.append(browser)
 
     log_info(f'Creating captures schedule for {browser_name}')
 
     tasklist = []
     for (i, page_url) in enumerate(url_list):
+        widths = [w for w in page_widths if in_shard(url_paths[i], browser_name, w)]
+        if len(widths) == 0:
+            continue
+
         tasks = await capture_screenshot_for_url(
             browser,
             browser_type,
-            page_widths,
+            widths,
             path_safe(url_paths[i]),
             page_url,
+            diff_queue,
         )
         tasklist.extend(tasks)
 
@@ -175,60 +430,321 @@ async def capture_screenshots_for(browser_type, page_widths, urls, url_paths):
     return tasklist
 
 
-async def call_diff_script(base_dir, result_dir, ground_truth_dir, compare_dir, url_path, browser_name, width, failures):
+def in_shard(url_path, browser_name, width):
+    return assigned_jobs is None or (path_safe(url_path), browser_name, width) in assigned_jobs
+
+
+def needs_diff(url_path, browser_name, width):
+    return in_shard(url_path, browser_name, width) and (browser_name, width, path_safe(url_path)) not in unchanged_jobs
+
+
+def unchanged_report(url_paths):
+    """
+    The jobs that were skipped for being unchanged, in url list order,
+    keyed the same way as the failures in the diff report.
+    """
+    unchanged = {}
+    for (browser_name, width, url_path) in unchanged_jobs:
+        unchanged.setdefault(f'{browser_name}-{width}', []).append(url_path)
+    order = [path_safe(u) for u in url_paths]
+    return {
+        key: sorted(paths, key=order.index)
+        for (key, paths) in sorted(unchanged.items())
+    }
+
+
+def assign_shard_jobs(browsers, url_paths):
+    """
+    Work out which jobs are ours, when only running a single shard.
+    """
+    global assigned_jobs
+
+    (index, count) = shard_spec
+    jobs = [
+        (path_safe(url_path), browser_type.name, page_width)
+        for url_path in url_paths
+        for browser_type in browsers
+        for page_width in page_widths
+    ]
+    timings = shard.load_timings(f'./{args.base_dir}/{shard.TIMINGS_FILE}')
+    (shards, loads) = shard.partition(jobs, count, timings)
+    assigned_jobs = shards[index - 1]
+    log_info(f'Shard {index}/{count}: {len(assigned_jobs)} of {len(jobs)} jobs, expected to take {loads[index - 1]:.0f}s')
+
+
+def save_width_timings():
+    """
+    Record how long each capture took, for balancing future shards.
+    """
+    if len(width_timings) == 0:
+        return
+    Path(f'./{args.base_dir}').mkdir(parents=True, exist_ok=True)
+    shard.save_timings(f'./{args.base_dir}/{shard.TIMINGS_FILE}', {
+        shard.job_key(t['path'], t['browser'], t['width']): round(t['navigate'] + t['stable'] + t['screenshot'], 3)
+        for t in width_timings
+    })
+
+
+def mirror_file(source, destination):
+    """
+    Make sure the destination is a copy of the source, by hardlinking it
+    where possible (falling back to a real copy), and not doing anything
+    at all if the destination already matches the source's size and mtime.
+    """
+    source_stat = os.stat(source)
+    if os.path.exists(destination):
+        destination_stat = os.stat(destination)
+        if os.path.samefile(source, destination):
+            return
+        if destination_stat.st_size == source_stat.st_size and destination_stat.st_mtime_ns == source_stat.st_mtime_ns:
+            return
+        os.remove(destination)
+
+    Path(destination).parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # e.g. the result dir is on a different device
+        copy2(source, destination)
+
+
+def report_entry(url_path, result=None):
+    """
+    The diffs.json entry for a failure: just its url path, or, when
+    recording boxes rather than writing masks, and/or writing thumbnails,
+    the url path along with the highlighted regions for the viewer to draw
+    and/or the index of thumbnail files for the viewer to show. Gating never
+    writes masks, so it always records regions, even if there are none.
+    """
+    if args.boxes is False and args.thumbnails is False and args.gate is False:
+        return url_path
+
+    result = result or {}
+    entry = { 'path': url_path }
+    if args.boxes is True or args.gate is True:
+        entry['regions'] = result.get('regions', [])
+    if args.thumbnails is True and 'thumbnails' in result:
+        entry['thumbnails'] = result['thumbnails']
+    return entry
+
+
+def mirror_ground_truth(base_dir, result_dir, ground_truth_dir, report):
+    """
+    Mirror the ground truth screenshots for everything that failed into
+    the result dir, so that the diff viewer can show them.
+    """
+    for (key, entries) in report.items():
+        for url_path in map(shard.entry_path, entries):
+            image_path = f'{key}/{url_path}/screenshot.png'
+            ground_truth = f'./{base_dir}/{ground_truth_dir}/{image_path}'
+            if os.path.exists(ground_truth):
+                mirror_file(ground_truth, f'./{result_dir}/{ground_truth_dir}/{image_path}')
+
+
+# pixel hashes for the ground truth screenshots, see HashManifest
+hash_manifest = None
+
+# recorded network responses, see NetworkStore
+network_store = None
+
+# capture fingerprints for the ground truth, see FingerprintManifest
+fingerprints = None
+
+# the (browser, width, url path) jobs that were skipped for being unchanged
+unchanged_jobs = set()
+
+# how many failures we found so far, for --max-failures
+failure_count = 0
+
+# limits how many diffs get handed to the diff engine at once, so that
+# we can still stop diffing once we hit the maximum number of failures.
+diff_slots = None
+
+# what we know about every diff region hash so far (see utils.highlight_diffs),
+# and the failing pages each of those regions showed up on.
+region_index = {}
+clusters = {}
+
+
+def reset_run_state():
+    """
+    Forget everything about the previous run, if there was one.
+    """
+    global open_browsers, width_timings, assigned_jobs, hash_manifest, network_store
+    global fingerprints, unchanged_jobs, failure_count, diff_slots, region_index, clusters
+
+    open_browsers = []
+    width_timings = []
+    assigned_jobs = None
+    hash_manifest = None
+    network_store = None
+    fingerprints = None
+    unchanged_jobs = set()
+    failure_count = 0
+    diff_slots = None
+    region_index = {}
+    clusters = {}
+
+    if args is not None and args.trace:
+        tracing.enable()
+    else:
+        tracing.disable()
+
+
+def run_stopped():
+    return args.max_failures > 0 and failure_count >= args.max_failures
+
+
+def count_failure(key, entry):
+    """
+    Keep track of the number of failures, stopping the run once we hit the maximum.
+    """
+    global failure_count
+    if result_listener is not None:
+        result_listener(key, entry)
+    failure_count += 1
+    if failure_count == args.max_failures:
+        log_info(f'Found {failure_count} failures, skipping all remaining captures and comparisons.')
+    return entry
+
+def write_file(path, data):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+async def call_diff_engine(engine, base_dir, result_dir, ground_truth_dir, compare_dir, url_path, browser_name, width, screenshot=None):
+    """
+    Diff a single screenshot pair, returning its diffs.json entry (see
+    report_entry) if the pair counts as a failure, or None if it doesn't.
+    If the screenshot's PNG data is passed in, it gets diffed as is,
+    rather than loaded from disk.
+    """
+    if run_stopped():
+        return
+
     url_path = path_safe(url_path)
 
     image_path = f'{browser_name}-{width}/{url_path}/screenshot.png'
     ground_truth = f'./{base_dir}/{ground_truth_dir}/{image_path}'
 
+    compare = f'./{base_dir}/{compare_dir}/{image_path}'
+
     if os.path.exists(ground_truth) is False:
         log_info(f'Cannot find {ground_truth} - skipping compare for {browser_name} at {width}px')
 
         if args.missing_error is True:
-            failures.append(url_path)
+            await keep_screenshot(base_dir, result_dir, compare, screenshot, url_path, browser_name, width)
+            return count_failure(f'{browser_name}-{width}', report_entry(url_path))
 
         return
 
-    compare = f'./{base_dir}/{compare_dir}/{image_path}'
-
     result_path = f'./{result_dir}/{compare_dir}/{browser_name}-{width}/{url_path}'
     Path(result_path).mkdir(parents=True, exist_ok=True)
-    cmd = f'{sys.executable} diff.py -w -r {result_path} {ground_truth} {compare}'
-
-    # are we comparing with relocation detection?
-    if args.match_origin:
-        cmd = f'{cmd} -o'
 
-    # what level of logging do we need for the diff.py call?
+    # what level of logging do we need for the diff run? Note that we
+    # log the terse pass/fail result here, rather than in the diff worker,
+    # because with parallel diffing it would otherwise not be clear which
+    # result belongs to which screenshot.
+    terse = False
+    silent = False
     if args.verbose == False or args.verbose_exclusive == True:
         if args.log_path_only is True:
             # no logging except for the diff pass/fail result
-            cmd = f'{cmd} -t'
-        else:
-            # no logging at all
-            cmd = f'{cmd} -s'
-
-
+            terse = True
+        # no logging at all, otherwise
+        silent = True
 
     if args.log_path_only is True:
         log_info(f'\ncomparing screenshots for {url_path} as taken by {browser_name} at {width}px...')
     else:
-        log_info(f'\ncalling {cmd}')
+        log_info(f'\ncomparing {ground_truth} to {compare}')
+
+    try:
+        waiting = tracing.now()
+        async with diff_slots:
+            tracing.complete('diff queue wait', 'diff', waiting, url=url_path, browser=browser_name, width=width)
+            if run_stopped():
+                return
+            with tracing.span('diff', 'diff', url=url_path, browser=browser_name, width=width):
+                # the diff workers don't follow us into other working
+                # directories (see serve.py), so they get absolute paths.
+                result = await engine.diff(
+                    os.path.abspath(ground_truth),
+                    os.path.abspath(compare) if screenshot is None else screenshot,
+                    result_path=os.path.abspath(result_path),
+                    match_origin=args.match_origin,
+                    silent=silent,
+                    original_hash=hash_manifest.get(image_path),
+                    tile_height=args.tile_height,
+                    align=args.align,
+                    search_band=args.search_band,
+                    use_cache=args.ground_truth_cache > 0,
+                    masks=not args.boxes,
+                    thumbnails=args.thumbnails,
+                    gate=(args.gate_score, args.gate_area) if args.gate else None,
+                    known_regions=dict(region_index) if args.clusters else None,
+                )
+        hash_manifest.set(image_path, result['original_hash'])
+        region_index.update(result.get('learned_regions', {}))
+    except ValueError as e:
+        log_info(f'Could not diff {compare}: {e}')
+        result = { 'passed': False }
 
-    return_code = os.system(cmd)
+    if terse is True:
+        outcome = 'no differences found' if result['passed'] else 'differences found'
+        print(f'- {url_path} ({browser_name} at {width}px): {outcome}.')
 
-    if return_code != 0:
-        copyfile(compare, compare.replace(f'{base_dir}/', f'{result_dir}/'))
-        failures.append(url_path)
+    if result['passed'] is False:
+        add_to_clusters(f'{browser_name}-{width}/{url_path}', result.get('regions', []))
+        await keep_screenshot(base_dir, result_dir, compare, screenshot, url_path, browser_name, width)
+        return count_failure(f'{browser_name}-{width}', report_entry(url_path, result))
 
 
-async def compare_screenshots(base_dir, result_dir, ground_truth_dir, compare_dir, url_paths, browser_name, width):
-    failures = []
+async def keep_screenshot(base_dir, result_dir, compare, screenshot, url_path, browser_name, width):
+    """
+    Put a failing screenshot in the result dir, for the viewer to show.
+    """
+    destination = compare.replace(f'{base_dir}/', f'{result_dir}/')
+    if screenshot is None:
+        mirror_file(compare, destination)
+    else:
+        # Playwright already encoded this PNG, so we can write it out
+        # as is, off the event loop, without touching the diffs dir.
+        loop = asyncio.get_running_loop()
+        with tracing.span('write screenshot', 'diff', url=url_path, browser=browser_name, width=width):
+            await loop.run_in_executor(None, write_file, destination, screenshot)
 
-    copy_tree(f'./{base_dir}/{ground_truth_dir}', f'./{result_dir}/{ground_truth_dir}')
 
-    for url_path in url_paths:
-        await call_diff_script(
+def add_to_clusters(page, regions):
+    for r in regions:
+        if 'cluster' not in r:
+            continue
+        pages = clusters.setdefault(r['cluster'], [])
+        # a page can have the same change in more than one place.
+        if all(p['path'] != page for p in pages):
+            pages.append({ 'path': page, 'kind': r['kind'], 'box': r['box'] })
+
+
+def cluster_report():
+    """
+    The diff region clusters, biggest first, as { hash: pages } with
+    each page listed as its "browser-width/url path" and region box.
+    """
+    ordered = sorted(clusters.items(), key=lambda c: (-len(c[1]), c[0]))
+    shared = [(digest, pages) for (digest, pages) in ordered if len(pages) > 1]
+    if len(shared) > 0:
+        log_info(f'{len(shared)} changes showed up on more than one page:')
+    for (digest, pages) in shared[:10]:
+        (x1, y1, x2, y2) = pages[0]['box']
+        log_info(f'- a {x2 - x1}x{y2 - y1}px {pages[0]["kind"]} appears on {len(pages)} pages, e.g. {pages[0]["path"]}')
+    return { digest: sorted(pages, key=lambda p: p['path']) for (digest, pages) in ordered }
+
+
+async def compare_screenshots(engine, base_dir, result_dir, ground_truth_dir, compare_dir, url_paths, browser_name, width):
+    results = await asyncio.gather(*[
+        call_diff_engine(
+            engine,
             base_dir,
             result_dir,
             ground_truth_dir,
@@ -236,25 +752,143 @@ async def compare_screenshots(base_dir, result_dir, ground_truth_dir, compare_di
             url_path,
             browser_name,
             width,
-            failures,
         )
+        for url_path in url_paths
+    ])
+
+    return [entry for entry in results if entry is not None]
 
-    return failures
+
+async def drain_diff_queue(engine, diff_queue, report):
+    """
+    Diff screenshots as they come in from the capture tasks, until we
+    get told there's nothing left to diff (by being handed a None).
+    """
+    while True:
+        job = await diff_queue.get()
+        if job is None:
+            return
+
+        (browser_name, width, url_path, screenshot) = job
+        try:
+            failure = await call_diff_engine(
+                engine,
+                args.base_dir,
+                args.result_dir,
+                args.ground_truth,
+                args.compare,
+                url_path,
+                browser_name,
+                width,
+                screenshot,
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # if this consumer stopped here (say, because a diff worker got
+            # killed, or the result dir isn't writable), the captures would
+            # wait forever for room in the queue, so we count it as a failure
+            # and carry on with the next one.
+            log_info(f'Could not diff {url_path} ({browser_name} at {width}px): {type(e).__name__}: {e}')
+            failure = count_failure(f'{browser_name}-{width}', report_entry(path_safe(url_path)))
+
+        if failure is not None:
+            report[f'{browser_name}-{width}'].append(failure)
 
 
-async def process_tasks(tasks, batch_size):
-    work_queue = []
-    batch_count = math.ceil(len(tasks) / batch_size)
-    batch = 1
-    while len(tasks) > 0:
-        log_info(f'[{batch}/{batch_count}] fetching URLs')
-        batch = batch + 1
-        work_queue = [
-            asyncio.create_task(task())
-            for task in tasks[:batch_size]
+async def process_tasks(tasks, queue_size, browser_queue_sizes, controller=None):
+    """
+    Run all capture tasks, keeping up to queue_size of them in flight at any
+    one time (and no more than the browser's own limit per browser), starting
+    the next task as soon as any running task finishes. Each task is a
+    (browser_name, label, task) tuple, and we return the per-task timings.
+    With a concurrency controller, its capture limit replaces queue_size.
+    """
+    overall = asyncio.Semaphore(queue_size) if controller is None else controller.captures
+    per_browser = {
+        name: asyncio.Semaphore(size or queue_size)
+        for (name, size) in browser_queue_sizes.items()
+    }
+    total = len(tasks)
+    timings = []
+
+    async def run_task(browser_name, label, task):
+        queued = time.monotonic()
+        waiting = tracing.now()
+        async with per_browser[browser_name], overall:
+            tracing.complete('capture queue wait', 'capture', waiting, url=label, browser=browser_name)
+            if run_stopped():
+                return
+            started = time.monotonic()
+            try:
+                with tracing.span('capture', 'capture', url=label, browser=browser_name):
+                    await task()
+            finally:
+                finished = time.monotonic()
+                timing = {
+                    'browser': browser_name,
+                    'task': label,
+                    'wait': started - queued,
+                    'run': finished - started,
+                }
+                timings.append(timing)
+                if controller is not None:
+                    controller.finished(timing['run'])
+                log_info(f'[{len(timings)}/{total}] {label} ({browser_name}): waited {timing["wait"]:.1f}s, ran {timing["run"]:.1f}s')
+
+    await asyncio.gather(*[
+        run_task(browser_name, label, task)
+        for (browser_name, label, task) in tasks
+    ])
+
+    slowest = sorted(timings, key=lambda t: t['run'], reverse=True)[:5]
+    if len(slowest) > 0:
+        log_info('Slowest captures:')
+        for timing in slowest:
+            log_info(f'- {timing["task"]} ({timing["browser"]}): {timing["run"]:.1f}s')
+
+    return timings
+
+
+def log_width_timings():
+    """
+    Summarise where capture time went, per browser and width.
+    """
+    groups = {}
+    for timing in width_timings:
+        groups.setdefault((timing['browser'], timing['width']), []).append(timing)
+
+    if len(groups) > 0:
+        log_info('Average capture times per width:')
+
+    for ((browser_name, page_width), timings) in sorted(groups.items()):
+        count = len(timings)
+        (navigate, stable, screenshot) = [
+            sum(t[phase] for t in timings) / count
+            for phase in ['navigate', 'stable', 'screenshot']
         ]
-        tasks = tasks[batch_size:]
-        await asyncio.gather(*work_queue)
+        log_info(f'- {browser_name} at {page_width}px ({count} captures): navigate {navigate:.1f}s, stabilise {stable:.1f}s, screenshot {screenshot:.1f}s')
+
+
+def save_trace():
+    """
+    Write out the trace for this run, along with a per-stage summary.
+    """
+    if tracing.enabled() is False:
+        return
+    trace_dir = f'./{args.result_dir}/{screenshot_base_dir}'
+    Path(trace_dir).mkdir(parents=True, exist_ok=True)
+    events = tracing.collect()
+    tracing.save(f'{trace_dir}/trace.json', events)
+    summary = tracing.summary(events)
+    with open(f'{trace_dir}/trace-summary.txt', 'w') as file:
+        file.write(summary + '\n')
+    log_info(f'\n{summary}\n\nWrote the trace for this run to {trace_dir}/trace.json')
+
+
+def enforce_cache_budget():
+    used = cache.enforce_budget(f'./{args.base_dir}/{args.ground_truth}', args.ground_truth_cache * 1024 * 1024)
+    log_info(f'Ground truth cache uses {used / (1024 * 1024):.1f}MB of its {args.ground_truth_cache}MB budget')
 
 
 async def capture_screenshots(urls):
@@ -264,64 +898,195 @@ async def capture_screenshots(urls):
     each other's execution.
     """
 
-    async with async_playwright() as p:
-        browsers = [p.chromium, p.firefox]  # we don't include p.webkit because it's just too fickle
-        url_paths = [url_stripper.sub('', u.strip()).strip('/') for u in url_list]
+    async with async_playwright() as p, DiffEngine(args.diff_workers) as engine:
+        return await capture_and_compare(p, engine)
 
-        if not args.compare_only:
-            tasklist = []
 
-            log_info('Setting up capture list')
-            for browser_type in browsers:
-                tasks = await capture_screenshots_for(
-                    browser_type,
-                    page_widths,
-                    urls,
-                    url_paths
-                )
-                tasklist.extend(tasks)
+async def capture_and_compare(p, engine):
+    """
+    Capture (and compare) everything, using an already running playwright
+    and diff engine. Returns the diff report, unless we're updating.
+    """
 
-            log_info('Executing captures')
-            await process_tasks(tasklist, args.queue_size)
+    global diff_slots
 
-            log_info('Finished captures.')
-            for browser in open_browsers:
-                await browser.close()
+    diff_slots = asyncio.Semaphore(args.diff_workers * 2)
+    if not args.adaptive_queue:
+        return await run_jobs(p, engine)
+
+    diff_slots = AdaptiveLimit('diffs', args.diff_workers, 1, args.diff_workers * 2)
+    captures = AdaptiveLimit('captures', args.min_queue_size, args.min_queue_size, args.queue_size)
+    controller = Controller(captures, diff_slots, log=log_info)
+
+    # the controller keeps adapting until all the diffs are done, not just
+    # the captures, so that diffs that are left after that can grow, too.
+    adapting = asyncio.ensure_future(controller.run())
+    try:
+        return await run_jobs(p, engine, controller)
+    finally:
+        adapting.cancel()
 
-        # TODO: we can almost certainly parallelise all diffing tasks
-        if not args.update:
-            log_info("comparing screenshots")
-            report = {}
-            failures = 0
 
+async def run_jobs(p, engine, controller=None):
+    """
+    Run all the captures, and diffs, for capture_and_compare.
+    """
+
+    global hash_manifest, network_store, fingerprints
+
+    browsers = [p.chromium, p.firefox]  # we don't include p.webkit because it's just too fickle
+    url_paths = [url_stripper.sub('', u.strip()).strip('/') for u in url_list]
+
+    report = {}
+    for browser_type in browsers:
+        for page_width in page_widths:
+            report[f'{browser_type.name}-{page_width}'] = []
+
+    if shard_spec is not None:
+        assign_shard_jobs(browsers, url_paths)
+
+    if not args.update:
+        hash_manifest = HashManifest(f'./{args.base_dir}/{args.ground_truth}')
+
+    # When streaming, diffing happens while we're still capturing.
+    streaming = (args.stream or args.in_memory) and not args.update and not args.compare_only
+    diff_queue = None
+    consumers = []
+
+    if streaming:
+        # bounded, so that captures wait for the diffs to catch up rather than
+        # piling up screenshots (which, with --in-memory, are all in memory).
+        diff_queue = asyncio.Queue(maxsize=2 * args.diff_workers)
+        # with an adaptive diff limit, there need to be more consumers than
+        # that limit for it to ever have diffs waiting, and grow.
+        consumers = [
+            asyncio.create_task(drain_diff_queue(engine, diff_queue, report))
+            for _ in range(args.diff_workers if controller is None else diff_slots.maximum)
+        ]
+
+    if not args.compare_only:
+        tasklist = []
+
+        if args.record or args.replay:
+            network_store = NetworkStore(f'./{args.base_dir}/network')
+
+        if args.update or args.incremental:
+            fingerprints = FingerprintManifest(f'./{args.base_dir}/{args.ground_truth}')
+
+        log_info('Setting up capture list')
+        for browser_type in browsers:
+            tasks = await capture_screenshots_for(
+                browser_type,
+                page_widths,
+                url_list,
+                url_paths,
+                diff_queue
+            )
+            tasklist.extend(tasks)
+
+        log_info('Executing captures')
+        try:
+            await process_tasks(tasklist, args.queue_size, {
+                'chromium': args.chromium_queue_size,
+                'firefox': args.firefox_queue_size,
+            }, controller)
+        finally:
+            # let the diff consumers know there's nothing more coming, without
+            # waiting here for them to make room in the queue.
+            for _ in consumers:
+                asyncio.ensure_future(diff_queue.put(None))
+
+        log_info('Finished captures.')
+        log_width_timings()
+        save_width_timings()
+
+        if args.update and fingerprints is not None:
+            fingerprints.save()
+        if len(unchanged_jobs) > 0:
+            log_info(f'Skipped {len(unchanged_jobs)} screenshots for unchanged pages')
+
+        if args.record:
+            await network_store.settle()
+            network_store.save()
+            log_info(f'Recorded {len(network_store.entries)} network responses')
+        if args.replay and network_store.misses > 0:
+            log_info(f'{network_store.misses} requests were not recorded, and got aborted')
+        for browser in open_browsers:
+            await browser.close()
+
+        if args.update and args.ground_truth_cache > 0:
+            log_info('Building ground truth cache')
+            screenshots = [
+                f'./{args.base_dir}/{args.ground_truth}/{browser_type.name}-{page_width}/{path_safe(url_path)}/screenshot.png'
+                for browser_type in browsers
+                for page_width in page_widths
+                for url_path in url_paths
+            ]
+            await asyncio.gather(*[
+                engine.cache(os.path.abspath(screenshot))
+                for screenshot in screenshots
+                if os.path.exists(screenshot)
+            ])
+            enforce_cache_budget()
+
+    if not args.update:
+        if streaming:
+            log_info("waiting for remaining comparisons")
+            await asyncio.gather(*consumers)
+
+            # diffs finish in whatever order, but the report should follow the url list.
+            order = [path_safe(u) for u in url_paths]
+            for key in report:
+                report[key].sort(key=lambda entry: order.index(shard.entry_path(entry)))
+
+        else:
+            log_info("comparing screenshots")
             for browser_type in browsers:
                 for page_width in page_widths:
                     key = f'{browser_type.name}-{page_width}'
                     report[key] = await compare_screenshots(
+                        engine,
                         args.base_dir,
                         args.result_dir,
                         args.ground_truth,
                         args.compare,
-                        url_paths,
+                        [u for u in url_paths if needs_diff(u, browser_type.name, page_width)],
                         browser_type.name,
                         page_width
                     )
-                    failures += len(report[key])
-
-            # Save the diff report as a JSON file in the result dir for this compare branch
-            result_file = open(f'./{args.result_dir}/{args.compare}/diffs.json', 'w')
-            result_file.write(json.dumps(report, indent=2))
-            result_file.close()
-
-            if failures > 0:
-                if args.server_hint is True:
-                    log_info(f'\nVisual diffs found in {failures} screenshots')
-                    log_info(f'run:\n    python -m http.server --directory {args.result_dir} 8080')
-                    log_info(f'then open:\n    http://localhost:8080/?reference={args.ground_truth}&compare={args.compare}')
-                sys.exit(failures)
 
-
-if len(url_list) == 0:
-    parser.print_help()
-else:
-    asyncio.run(capture_screenshots(url_list))
+        hash_manifest.save()
+        if args.ground_truth_cache > 0:
+            enforce_cache_budget()
+        failures = sum(len(v) for v in report.values())
+        mirror_ground_truth(args.base_dir, args.result_dir, args.ground_truth, report)
+
+        # Save the diff report as a JSON file in the result dir for this compare branch
+        Path(f'./{args.result_dir}/{args.compare}').mkdir(parents=True, exist_ok=True)
+        output = dict(report)
+        if args.incremental:
+            output['unchanged'] = unchanged_report(url_paths)
+        if args.clusters:
+            output['clusters'] = cluster_report()
+        result_file = open(f'./{args.result_dir}/{args.compare}/diffs.json', 'w')
+        result_file.write(json.dumps(output, indent=2))
+        result_file.close()
+        save_trace()
+
+        if failures > 0 and args.server_hint is True:
+            log_info(f'\nVisual diffs found in {failures} screenshots')
+            log_info(f'run:\n    python -m http.server --directory {args.result_dir} 8080')
+            log_info(f'then open:\n    http://localhost:8080/?reference={args.ground_truth}&compare={args.compare}')
+
+        return output
+
+    save_trace()
+
+
+if __name__ == '__main__':
+    configure()
+    if len(url_list) == 0:
+        parser.print_help()
+    else:
+        report = asyncio.run(capture_screenshots(url_list))
+        sys.exit(shard.exit_status(shard.count_failures(report) if report else 0))
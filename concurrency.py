@@ -0,0 +1,214 @@
+"""
+Adaptive concurrency: rather than always keeping a fixed number of captures
+(and diffs) in flight, a controller periodically looks at how much memory
+the system has left, how busy its CPUs are, and how long recent captures
+took, and grows or shrinks the number of captures and diffs that may run
+at the same time, within fixed bounds.
+
+Memory and CPU use are read from /proc on Linux. Elsewhere, CPU use falls
+back to the load average, and memory pressure is not taken into account.
+"""
+
+import os
+import asyncio
+import statistics
+
+from collections import deque
+
+import tracing
+
+
+# Below this fraction of available memory, halve everything right away.
+MEMORY_LOW = 0.1
+
+# Only grow while at least this fraction of memory is available.
+MEMORY_COMFORTABLE = 0.25
+
+# Above this fraction of CPU use, adding more work won't make things go
+# any faster, so we stop growing.
+CPU_BUSY = 0.95
+
+# How much slower recent captures may get after growing, before we
+# consider that growth a mistake and shrink back.
+LATENCY_SLACK = 0.5
+
+# How many recent capture timings get looked at.
+LATENCY_WINDOW = 20
+
+
+def available_memory():
+	"""
+	The fraction of memory still available, or None if we can't tell.
+	"""
+	try:
+		with open('/proc/meminfo', 'r') as meminfo:
+			values = dict(line.split(':', 1) for line in meminfo)
+		total = int(values['MemTotal'].split()[0])
+		available = int(values['MemAvailable'].split()[0])
+		return available / total
+	except (OSError, KeyError, ValueError):
+		return None
+
+
+class CpuMeter:
+	"""
+	Measures how busy the CPUs were since the last time we asked, using
+	/proc/stat where available, and the load average otherwise.
+	"""
+
+	def __init__(self):
+		self.previous = self.read()
+
+	def read(self):
+		try:
+			with open('/proc/stat', 'r') as stat:
+				values = [int(v) for v in stat.readline().split()[1:]]
+		except (OSError, ValueError):
+			return None
+		# idle and iowait don't count as busy.
+		idle = values[3] + (values[4] if len(values) > 4 else 0)
+		return (sum(values) - idle, sum(values))
+
+	def busy(self):
+		current = self.read()
+		if current is None or self.previous is None:
+			try:
+				return os.getloadavg()[0] / (os.cpu_count() or 1)
+			except OSError:
+				return None
+		(busy, total) = (current[0] - self.previous[0], current[1] - self.previous[1])
+		self.previous = current
+		return busy / total if total > 0 else None
+
+
+class AdaptiveLimit:
+	"""
+	Like an asyncio.Semaphore, except that its limit can be changed (within
+	its bounds) while it's in use. Lowering the limit doesn't interrupt
+	anything, it just means nothing new gets let in until enough of what's
+	already running has finished.
+	"""
+
+	def __init__(self, name, limit, minimum, maximum):
+		self.name = name
+		self.minimum = minimum
+		self.maximum = maximum
+		self.limit = max(minimum, min(limit, maximum))
+		self.active = 0
+		self.waiting = 0
+		self.condition = asyncio.Condition()
+
+	async def __aenter__(self):
+		async with self.condition:
+			self.waiting += 1
+			try:
+				await self.condition.wait_for(lambda: self.active < self.limit)
+			finally:
+				self.waiting -= 1
+			self.active += 1
+
+	async def __aexit__(self, *exc):
+		async with self.condition:
+			self.active -= 1
+			self.condition.notify_all()
+
+	def saturated(self):
+		return self.active >= self.limit and self.waiting > 0
+
+	async def resize(self, limit):
+		"""
+		Change the limit, returning the new limit.
+		"""
+		async with self.condition:
+			self.limit = max(self.minimum, min(limit, self.maximum))
+			self.condition.notify_all()
+		return self.limit
+
+
+class Controller:
+	"""
+	Periodically resizes the capture and diff limits: halving both when
+	memory runs low, taking a capture away when captures got slower after
+	the last time we grew, and adding one of each while there is memory and
+	CPU to spare, and work waiting for it.
+	"""
+
+	def __init__(self, captures, diffs, interval=1.0, log=print):
+		self.captures = captures
+		self.diffs = diffs
+		self.interval = interval
+		self.log = log
+		self.cpu = CpuMeter()
+		self.latencies = deque(maxlen=LATENCY_WINDOW)
+		self.grew_from = None
+
+	def finished(self, seconds):
+		"""
+		Let the controller know a capture finished, and how long it took.
+		"""
+		self.latencies.append(seconds)
+
+	def decide(self, memory, cpu, latency):
+		"""
+		Work out the new (capture, diff) limits, and why, given the fraction
+		of memory available, the fraction of CPU in use, and the median time
+		recent captures took (each of which may be None, if unknown).
+		Returns None if nothing needs to change.
+		"""
+		(captures, diffs) = (self.captures.limit, self.diffs.limit)
+
+		if memory is not None and memory < MEMORY_LOW:
+			return (captures // 2, diffs // 2, f'only {memory:.0%} of memory available')
+
+		if self.grew_from is not None and latency is not None and latency > self.grew_from * (1 + LATENCY_SLACK):
+			return (captures - 1, diffs, f'captures slowed down from {self.grew_from:.1f}s to {latency:.1f}s')
+
+		if memory is not None and memory < MEMORY_COMFORTABLE:
+			return None
+
+		if cpu is not None and cpu > CPU_BUSY:
+			return None
+
+		(grow_captures, grow_diffs) = (self.captures.saturated(), self.diffs.saturated())
+		if grow_captures or grow_diffs:
+			return (captures + (1 if grow_captures else 0), diffs + (1 if grow_diffs else 0), 'there is headroom, and work waiting')
+
+		return None
+
+	async def adjust(self):
+		memory = available_memory()
+		cpu = self.cpu.busy()
+		latency = statistics.median(self.latencies) if len(self.latencies) > 0 else None
+
+		decision = self.decide(memory, cpu, latency)
+		if decision is None:
+			return
+
+		(captures, diffs, reason) = decision
+		(before_captures, before_diffs) = (self.captures.limit, self.diffs.limit)
+		captures = await self.captures.resize(captures)
+		diffs = await self.diffs.resize(diffs)
+		if (captures, diffs) == (before_captures, before_diffs):
+			return
+
+		# remember how fast captures were before growing, so we can tell if that helped.
+		self.grew_from = latency if captures > before_captures else None
+		if captures != before_captures:
+			self.latencies.clear()
+
+		tracing.counter('concurrency', captures=captures, diffs=diffs)
+		changes = [
+			f'{before} -> {after} {name}'
+			for (name, before, after) in [('captures', before_captures, captures), ('diffs', before_diffs, diffs)]
+			if before != after
+		]
+		self.log(f'Concurrency: {", ".join(changes)} ({reason})')
+
+	async def run(self):
+		"""
+		Keep adjusting the limits until cancelled.
+		"""
+		tracing.counter('concurrency', captures=self.captures.limit, diffs=self.diffs.limit)
+		while True:
+			await asyncio.sleep(self.interval)
+			await self.adjust()
@@ -11,25 +11,29 @@ utils = importlib.import_module('utils')
 parser = argparse.ArgumentParser(description='Diff two (bitmap) images.')
 parser.add_argument('original', help='The path for the original image.')
 parser.add_argument('new', help='The path for the new image.')
+parser.add_argument('-a', '--align', action='store_true', help='Align the rows of both images first, so that inserted or removed content does not flag everything below it.')
 parser.add_argument('-o', '--match-origin', action='store_true', help='Try to detect relocated content.')
 parser.add_argument('-p', '--max-passes', type=int, default=5, help="The maximum number of diff-merge passes. defaults to 5.")
 parser.add_argument('-r', '--result-path', default='results', help="The dir to write the comparison results to. defaults to results.")
+parser.add_argument('-sb', '--search-band', type=int, default=0, help="Only look for relocated content within this many pixels above or below where it is now. defaults to 0 (search the whole image).")
 parser.add_argument('-s', '--silent', action='store_true', help="Do not log progress to stdout.")
+parser.add_argument('-th', '--tile-height', type=int, default=0, help="Only compare the horizontal bands of this height that actually changed. defaults to 0 (compare the whole image).")
 parser.add_argument('-t', '--terse-logging', action='store_true', help="Only log diff pass/fail result.")
 parser.add_argument('-w', '--write', action='store_true', help='Write the highlighted images to disk.')
 args = parser.parse_args()
 
 image_pair = utils.make_same_size(
 	utils.loadImage(args.original),
-	utils.loadImage(args.new)
+	utils.loadImage(args.new),
+	same_height=not args.align
 )
 
 if args.terse_logging is True:
 	args.silent = True
 
-diffs = utils.perform_diffing(image_pair, args.write, args.result_path, args.match_origin, args.max_passes, args.terse_logging, args.silent)
+result = utils.perform_diffing(image_pair, args.write, args.result_path, args.match_origin, args.max_passes, args.terse_logging, args.silent, args.tile_height, args.align, args.search_band)
 
-if diffs is not None:
+if result['passed'] is False:
 	if args.silent is False:
-		print(f'{len(diffs)} differences found.')
+		print(f'{len(result["diffs"])} differences found.')
 	sys.exit(1)
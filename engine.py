@@ -0,0 +1,205 @@
+"""
+Diff engine requires:
+
+- opencv-python
+- imutils
+
+Rather than starting a new `diff.py` interpreter for every screenshot pair,
+the engine keeps a pool of long-lived worker processes around that have
+already imported cv2 and the rest of the diff code, and hands each of them
+image pairs to diff via utils.perform_diffing.
+"""
+
+import os
+import json
+import asyncio
+import functools
+
+from concurrent.futures import ProcessPoolExecutor
+
+import cache
+import utils
+import tracing
+
+
+def diff_pair(original, new, result_path='results', match_origin=False, max_passes=5, terse=False, silent=False, original_hash=None, tile_height=0, align=False, search_band=0, use_cache=False, masks=True, thumbnails=False, gate=None, known_regions=None):
+	"""
+	Load, size-match and diff an image pair, writing the highlight masks
+	to the result path (unless masks is False, in which case only the
+	result's regions describe the highlights). This runs inside a worker
+	process.
+
+	If we already know the pixel hash for the original, and the new image
+	hashes the same, we don't even need to load the original. The result
+	includes the original's hash so that it can be recorded for next time.
+
+	When using the ground truth cache, the original gets memory-mapped from
+	its cache entry (see cache.py) rather than decoded, with a cache entry
+	getting built for next time if there wasn't an up to date one.
+
+	The new image can also be passed in as encoded PNG data rather than a
+	path, in which case it gets decoded here without ever touching disk.
+
+	Regions whose relocation search already happened for another pair can
+	be passed in as known_regions (see utils.highlight_diffs).
+	"""
+	with tracing.span('load new', 'diff') as span:
+		b = utils.decodeImage(new) if isinstance(new, bytes) else utils.loadImage(new)
+		span['size'] = f'{b.shape[1]}x{b.shape[0]}'
+
+	if original_hash is not None and original_hash == utils.pixel_hash(b):
+		if silent is False:
+			print('images are pixel-identical, no differences found.')
+		result = utils.diff_result()
+		result['original_hash'] = original_hash
+		return result
+
+	(planes, rows) = (None, None)
+	with tracing.span('load original', 'diff') as span:
+		cached = cache.load(original) if use_cache else None
+		span['cached'] = cached is not None
+		if cached is not None:
+			(a, planes, rows) = cached
+		else:
+			a = utils.loadImage(original)
+			if use_cache:
+				cache.build(original, a)
+
+	if original_hash is None:
+		original_hash = utils.pixel_hash(a)
+
+	# when aligning rows, differences in page height are handled by the alignment.
+	image_pair = utils.make_same_size(a, b, same_height=not align)
+
+	# the cached planes and row hashes need to match the (cropped) original.
+	cropped = image_pair[0]
+	if planes is not None:
+		planes = planes[:cropped.shape[0], :cropped.shape[1]]
+	if cropped.shape[1] != a.shape[1]:
+		rows = None
+
+	result = utils.perform_diffing(image_pair, True, result_path, match_origin, max_passes, terse, silent, tile_height, align, search_band, planes, rows, masks, thumbnails, gate, known_regions)
+	result['original_hash'] = original_hash
+	return result
+
+
+def worker_ready():
+	"""
+	A no-op for warming up workers: running this in a worker makes it import
+	this module (and with it, cv2 and the rest of the diff code).
+	"""
+	return os.getpid()
+
+
+class HashManifest:
+	"""
+	Pixel hashes for the screenshots in a ground truth dir, stored as
+	hashes.json in that dir, so that baseline screenshots only ever need
+	to be hashed once. Entries are keyed on the path relative to the dir,
+	and are ignored once the file's size or mtime no longer match.
+	"""
+
+	filename = 'hashes.json'
+
+	def __init__(self, dir):
+		self.dir = dir
+		self.path = f'{dir}/{self.filename}'
+		self.entries = {}
+		self.changed = False
+		if os.path.exists(self.path):
+			with open(self.path, 'r') as manifest:
+				self.entries = json.load(manifest)
+
+	def stat(self, image_path):
+		stat = os.stat(f'{self.dir}/{image_path}')
+		return stat.st_size, stat.st_mtime_ns
+
+	def get(self, image_path):
+		entry = self.entries.get(image_path)
+		if entry is None or os.path.exists(f'{self.dir}/{image_path}') is False:
+			return None
+		(size, mtime) = self.stat(image_path)
+		if entry['size'] != size or entry['mtime'] != mtime:
+			return None
+		return entry['hash']
+
+	def set(self, image_path, hash):
+		if hash is None or self.get(image_path) == hash:
+			return
+		(size, mtime) = self.stat(image_path)
+		self.entries[image_path] = { 'hash': hash, 'size': size, 'mtime': mtime }
+		self.changed = True
+
+	def save(self):
+		if self.changed is False:
+			return
+		with open(self.path, 'w') as manifest:
+			json.dump(self.entries, manifest, indent=2, sort_keys=True)
+		self.changed = False
+
+
+class DiffEngine:
+	"""
+	A process pool for running diffs off the event loop. Use as an (async)
+	context manager so the workers get shut down once we're done.
+	"""
+
+	def __init__(self, workers=None):
+		self.workers = workers or os.cpu_count() or 1
+		self.executor = None
+
+	def start(self):
+		if self.executor is None:
+			self.executor = ProcessPoolExecutor(max_workers=self.workers)
+		return self
+
+	def shutdown(self):
+		if self.executor is not None:
+			self.executor.shutdown(wait=True)
+			self.executor = None
+
+	async def diff(self, original, new, **options):
+		"""
+		Diff an image pair in a worker, returning the structured result
+		of utils.perform_diffing (passed, score and diff boxes). When
+		tracing, the worker's spans get added to our own trace.
+		"""
+		self.start()
+		loop = asyncio.get_running_loop()
+		if tracing.enabled() is False:
+			task = functools.partial(diff_pair, original, new, **options)
+			return await loop.run_in_executor(self.executor, task)
+
+		task = functools.partial(tracing.run_traced, original, diff_pair, original, new, **options)
+		(result, events) = await loop.run_in_executor(self.executor, task)
+		tracing.add(events)
+		return result
+
+	async def warm_up(self):
+		"""
+		Start all workers right away, rather than on the first diff, so that
+		they are done importing everything by the time the diffs come in.
+		"""
+		self.start()
+		loop = asyncio.get_running_loop()
+		pids = await asyncio.gather(*[
+			loop.run_in_executor(self.executor, worker_ready)
+			for _ in range(self.workers)
+		])
+		return len(set(pids))
+
+	async def cache(self, image_path):
+		"""
+		(Re)build the ground truth cache entry for a screenshot in a worker.
+		"""
+		self.start()
+		loop = asyncio.get_running_loop()
+		return await loop.run_in_executor(self.executor, cache.build, image_path)
+
+	async def __aenter__(self):
+		# workers get started on the first diff, so runs that
+		# never end up diffing anything don't pay for them.
+		return self
+
+	async def __aexit__(self, *exc):
+		self.shutdown()
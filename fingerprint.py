@@ -0,0 +1,100 @@
+"""
+Capture fingerprints require:
+
+- playwright
+
+A fingerprint summarises what a page looked like to the browser at the
+moment we would take its screenshot: the (stabilised) DOM, plus the content
+hashes of every resource the page loaded. Ground truth runs record these,
+so that incremental compare runs can skip the screenshot (and the diff)
+for any page whose fingerprint did not change, since that page should
+render exactly the same as its ground truth screenshot.
+"""
+
+import os
+import json
+import asyncio
+import hashlib
+
+from playwright.async_api import Error
+
+
+class ResourceLog:
+	"""
+	The content hashes for all responses that a page received.
+	"""
+
+	def __init__(self):
+		self.hashes = {}
+		self.pending = set()
+
+	def attach(self, page):
+		page.on('response', self.record)
+		return self
+
+	def record(self, response):
+		# reading the body is async, so track it until we need the result.
+		task = asyncio.ensure_future(self.hash(response))
+		self.pending.add(task)
+		task.add_done_callback(self.pending.discard)
+
+	async def hash(self, response):
+		h = hashlib.blake2b(digest_size=16)
+		h.update(str(response.status).encode())
+		try:
+			h.update(await response.body())
+		except Error:
+			# redirects and aborted requests have no body to hash.
+			pass
+		self.hashes[response.url] = h.hexdigest()
+
+	async def settle(self):
+		if len(self.pending) > 0:
+			await asyncio.gather(*self.pending, return_exceptions=True)
+
+
+async def fingerprint(page, resources):
+	"""
+	Fingerprint a page based on its current DOM and the resources it loaded.
+	"""
+	await resources.settle()
+	h = hashlib.blake2b(digest_size=16)
+	h.update((await page.content()).encode())
+	for url in sorted(resources.hashes):
+		h.update(f'\n{url} {resources.hashes[url]}'.encode())
+	return h.hexdigest()
+
+
+class FingerprintManifest:
+	"""
+	Capture fingerprints for a ground truth dir, stored as fingerprints.json
+	in that dir, keyed on the same "browser-width/url path" as its screenshots.
+	"""
+
+	filename = 'fingerprints.json'
+
+	def __init__(self, dir):
+		self.dir = dir
+		self.path = f'{dir}/{self.filename}'
+		self.entries = {}
+		self.changed = False
+		if os.path.exists(self.path):
+			with open(self.path, 'r') as manifest:
+				self.entries = json.load(manifest)
+
+	def get(self, key):
+		return self.entries.get(key)
+
+	def set(self, key, value):
+		if self.entries.get(key) == value:
+			return
+		self.entries[key] = value
+		self.changed = True
+
+	def save(self):
+		if self.changed is False:
+			return
+		os.makedirs(self.dir, exist_ok=True)
+		with open(self.path, 'w') as manifest:
+			json.dump(self.entries, manifest, indent=2, sort_keys=True)
+		self.changed = False
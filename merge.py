@@ -0,0 +1,39 @@
+"""
+Combine the diffs.json reports from several `compare.py --shard i/N` runs
+into a single report for the diff viewer, exiting with the total number
+of failures, the same way a single (unsharded) compare.py run would.
+"""
+
+import os
+import sys
+import json
+import argparse
+
+import shard
+
+parser = argparse.ArgumentParser(description='Merge the diff reports of sharded compare.py runs.')
+parser.add_argument('reports', nargs='+', help='The diffs.json files to merge.')
+parser.add_argument('-o', '--output', default='results/compare/diffs.json', help="Where to write the merged report. defaults to results/compare/diffs.json.")
+parser.add_argument('-t', '--timings', nargs='*', default=[], help="The shards' timings.json files, to merge for balancing future shards.")
+parser.add_argument('-to', '--timings-output', default=f'diffs/{shard.TIMINGS_FILE}', help=f"Where to write the merged timings. defaults to diffs/{shard.TIMINGS_FILE}.")
+args = parser.parse_args()
+
+reports = []
+for path in args.reports:
+	with open(path, 'r') as report:
+		reports.append(json.load(report))
+
+merged = shard.merge_reports(reports)
+failures = shard.count_failures(merged)
+
+os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+with open(args.output, 'w') as output:
+	output.write(json.dumps(merged, indent=2))
+
+if len(args.timings) > 0:
+	os.makedirs(os.path.dirname(args.timings_output) or '.', exist_ok=True)
+	for path in args.timings:
+		shard.save_timings(args.timings_output, shard.load_timings(path))
+
+print(f'Merged {len(reports)} reports, with {failures} failures.')
+sys.exit(shard.exit_status(failures))
@@ -0,0 +1,125 @@
+"""
+Network store requires:
+
+- playwright
+
+When recording, every response a capture receives gets stored on disk, with
+the response bodies stored content-addressed (by their hash) so that assets
+like fonts, images and CSS that get used by many pages (and both browsers)
+are only stored once. When replaying, all requests are answered from that
+store instead of the network (redirects included, which get replayed with
+their status and location), and anything that wasn't recorded is aborted,
+so captures no longer depend on how fast (or how consistent) the network is.
+"""
+
+import os
+import json
+import asyncio
+import hashlib
+
+from playwright.async_api import Error
+
+
+# Response headers that no longer apply once we hand back the decoded body.
+DROPPED_HEADERS = ['content-encoding', 'content-length', 'transfer-encoding']
+
+
+class NetworkStore:
+	"""
+	Recorded responses, stored as an index.json of request (method and url)
+	to response (status, headers and body hash), plus an objects dir with
+	one file per response body, named after its hash.
+	"""
+
+	filename = 'index.json'
+
+	def __init__(self, dir):
+		self.dir = dir
+		self.path = f'{dir}/{self.filename}'
+		self.objects = f'{dir}/objects'
+		self.entries = {}
+		self.changed = False
+		self.misses = 0
+		self.pending = set()
+		if os.path.exists(self.path):
+			with open(self.path, 'r') as index:
+				self.entries = json.load(index)
+
+	def key(self, request):
+		return f'{request.method} {request.url}'
+
+	async def attach(self, page, replay=False):
+		"""
+		Record the responses for everything this page loads, or, when
+		replaying, answer all of its requests from the store.
+		"""
+		if replay:
+			await page.route('**/*', self.replay)
+		else:
+			page.on('response', self.record)
+
+	def record(self, response):
+		# reading the body is async, so track it until the page gets closed.
+		task = asyncio.ensure_future(self.store(response))
+		self.pending.add(task)
+		task.add_done_callback(self.pending.discard)
+
+	async def settle(self):
+		"""
+		Wait for the responses that are still being recorded, which needs
+		to happen before the page they belong to gets closed.
+		"""
+		if len(self.pending) > 0:
+			await asyncio.gather(*self.pending, return_exceptions=True)
+
+	async def store(self, response):
+		if 300 <= response.status < 400:
+			# redirects have no body (and asking for it raises), but they still
+			# need replaying, or the request that got redirected gets aborted.
+			body = b''
+		else:
+			try:
+				body = await response.body()
+			except Error:
+				# aborted requests have no body to record.
+				return
+
+		digest = hashlib.blake2b(body, digest_size=16).hexdigest()
+		object_path = f'{self.objects}/{digest}'
+		if os.path.exists(object_path) is False:
+			os.makedirs(self.objects, exist_ok=True)
+			with open(object_path, 'wb') as file:
+				file.write(body)
+
+		headers = {
+			name: value
+			for (name, value) in response.headers.items()
+			if name.lower() not in DROPPED_HEADERS
+		}
+		self.entries[self.key(response.request)] = {
+			'status': response.status,
+			'headers': headers,
+			'body': digest,
+		}
+		self.changed = True
+
+	async def replay(self, route, request):
+		entry = self.entries.get(self.key(request))
+		if entry is None:
+			self.misses += 1
+			await route.abort()
+			return
+
+		await route.fulfill(
+			status=entry['status'],
+			headers=entry['headers'],
+			path=f'{self.objects}/{entry["body"]}',
+		)
+
+	def save(self):
+		if self.changed is False:
+			return
+		os.makedirs(self.dir, exist_ok=True)
+		with open(self.path, 'w') as index:
+			json.dump(self.entries, index, indent=2, sort_keys=True)
+		self.changed = False
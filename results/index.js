@@ -6,9 +6,50 @@ const create = document.createElement.bind(document);
 // Fetch the diff list for this comparison
 (async function () {
   const data = await fetch(`./${compareId}/diffs.json`).then((r) => r.json());
-  Object.entries(data).forEach(processDiffs);
+  // only the "browser-width" lists are diffs, e.g. "unchanged" is not.
+  Object.entries(data)
+    .filter(([_, difflist]) => Array.isArray(difflist))
+    .forEach(processDiffs);
+  if (data.clusters) processClusters(data.clusters);
 })();
 
+/**
+ * Changes that show up on more than one page (from running compare.py
+ * with --clusters) get listed up front, so they only need reviewing once.
+ */
+function processClusters(clusters) {
+  const shared = Object.values(clusters)
+    .filter((pages) => pages.length > 1)
+    .sort((a, b) => b.length - a.length);
+
+  if (!shared.length) return;
+
+  const section = create(`section`);
+  section.classList.add(`clusters`);
+  section.innerHTML = `
+    <h2>Changes that show up on more than one page</h2>
+  `;
+
+  shared.forEach((pages) => {
+    const [{ kind, box: [x1, y1, x2, y2] }] = pages;
+    const details = create(`details`);
+    const summary = create(`summary`);
+    summary.textContent = `A ${x2 - x1}x${y2 - y1}px ${kind} at (${x1}, ${y1}) appears on ${pages.length} pages`;
+    details.append(summary);
+
+    const list = create(`ul`);
+    pages.forEach(({ path }) => {
+      const item = create(`li`);
+      item.textContent = path;
+      list.append(item);
+    });
+    details.append(list);
+    section.append(details);
+  });
+
+  diffs.before(section);
+}
+
 /**
  * ... docs go here...
  */
@@ -46,7 +87,9 @@ function processDiffs([browserWidth, difflist]) {
   const section = create(`section`);
   diffs.append(section);
 
-  const imageSets = difflist.map((diff) => buildImage(browserWidth, diff));
+  const imageSets = difflist.map((entry) =>
+    entry.thumbnails ? buildPreview(browserWidth, entry) : buildImage(browserWidth, entry)
+  );
   imageSets.forEach(set => processImageSet(section, set));
 }
 
@@ -64,18 +107,93 @@ function processImageSet(section, set) {
   figureSet.append(set.original);
   figureSet.append(set.compare);
   specificDiff.append(figureSet);
+
+  // previews only load the full size screenshots when asked to.
+  if (set.crops) {
+    specificDiff.append(set.crops);
+    const button = create(`button`);
+    button.textContent = `Show full size screenshots`;
+    button.addEventListener(`click`, () => {
+      const full = buildImage(set.browserWidth, set.entry);
+      figureSet.replaceChildren(full.original, full.compare);
+      button.remove();
+    });
+    specificDiff.append(button);
+  }
+
   section.append(specificDiff);
 }
 
+/**
+ * Entries with thumbnails (from running compare.py with --thumbnails) get
+ * shown as downscaled pages plus before/after crops of each diff region.
+ */
+function buildPreview(browserWidth, entry) {
+  const { path: diff, thumbnails } = entry;
+  const diffBase = `./${compareId}/${browserWidth}/${diff}`;
+
+  const crops = create(`div`);
+  crops.classList.add(`crops`);
+  thumbnails.crops.forEach(({ kind, before, after }) => {
+    const figure = create(`figure`);
+    figure.classList.add(`crop`, kind);
+    [before, after]
+      .filter(Boolean)
+      .forEach((name) => figure.append(buildLazyImage(`${diffBase}/${name}`)));
+    crops.append(figure);
+  });
+
+  return {
+    diff,
+    browserWidth,
+    entry,
+    original: buildThumbnail(`${diffBase}/${thumbnails.original}`, "reference"),
+    compare: buildThumbnail(`${diffBase}/${thumbnails.compare}`, "compare"),
+    crops,
+  };
+}
+
 /**
  * ... docs go here...
  */
- function buildImage(browserWidth, diff) {
+function buildThumbnail(src, classes='') {
+  const figure = create(`figure`);
+  figure.classList.add(`thumbnail`, classes);
+  figure.append(buildLazyImage(src));
+  return figure;
+}
+
+/**
+ * Images that only get fetched once they're (nearly) scrolled into view.
+ */
+function buildLazyImage(src) {
+  const img = new Image();
+  img.loading = `lazy`;
+  img.src = src;
+  return img;
+}
+
+/**
+ * Diff list entries are either a url path, in which case the highlights
+ * come from the mask images, or a { path, regions } object (from running
+ * compare.py with --boxes or --gate), in which case we draw the regions ourselves.
+ */
+ function buildImage(browserWidth, entry) {
+  const diff = typeof entry === `string` ? entry : entry.path;
   const original = `./${referenceId}/${browserWidth}/${diff}/screenshot.png`;
   const diffBase = `./${compareId}/${browserWidth}/${diff}`;
   const compare = `${diffBase}/screenshot.png`;
-  const originalMask = `${diffBase}/original_mask.png`;
-  const diffMask = `${diffBase}/diff_mask.png`;
+  let originalMask = `${diffBase}/original_mask.png`;
+  let diffMask = `${diffBase}/diff_mask.png`;
+
+  if (entry.regions) {
+    // relocated content gets highlighted at its origin in the reference,
+    // removed content only exists in the reference, and diffs only in the compare.
+    originalMask = entry.regions
+      .filter(({ kind }) => kind !== `diff`)
+      .map(({ kind, box, origin }) => ({ kind, box: origin || box }));
+    diffMask = entry.regions.filter(({ kind }) => kind !== `removed`);
+  }
 
   return {
     diff,
@@ -86,7 +204,8 @@ function processImageSet(section, set) {
 }
 
 /**
- * ... docs go here...
+ * The overlay is either the url for a mask image, or a list of
+ * { kind, box } regions to draw on top of the screenshot.
  */
  function buildImageElement(screenshot, overlay, classes='') {
   const figure = create(`figure`);
@@ -100,6 +219,11 @@ function processImageSet(section, set) {
   img.classList.add(`for-sizing-only`);
   figure.append(img);
 
+  if (Array.isArray(overlay)) {
+    figure.append(buildBoxOverlay(img, overlay, classes));
+    return figure;
+  }
+
   img = new Image();
   img.src = overlay;
   img.style.width = `100%`;
@@ -107,3 +231,29 @@ function processImageSet(section, set) {
   figure.append(img);
   return figure;
 }
+
+/**
+ * Draw the regions as boxes, positioned in percentages of the screenshot's
+ * natural size, so they scale along with however big the figure ends up.
+ */
+function buildBoxOverlay(img, regions, classes) {
+  const overlay = create(`div`);
+  overlay.classList.add(classes, `overlay`, `boxes`);
+
+  img.addEventListener(`load`, () => {
+    const { naturalWidth: w, naturalHeight: h } = img;
+    regions.forEach(({ kind, box: [x1, y1, x2, y2] }) => {
+      const box = create(`div`);
+      box.classList.add(kind);
+      box.setAttribute(`style`, `
+        left: ${(100 * x1) / w}%;
+        top: ${(100 * y1) / h}%;
+        width: ${(100 * (x2 - x1 + 1)) / w}%;
+        height: ${(100 * (y2 - y1 + 1)) / h}%;
+      `);
+      overlay.append(box);
+    });
+  });
+
+  return overlay;
+}
@@ -0,0 +1,134 @@
+"""
+Compare server requires:
+
+- playwright
+
+as well as the diff engine requirements (see engine.py)
+
+Starting playwright, launching the browsers, and starting diff workers
+(which all need to import cv2) takes a good while, and for small jobs that
+is most of the time a compare.py run takes. This server does all of that
+once, and then runs the compare.py jobs that client.py sends it over a
+unix socket, one after another, streaming back each failure as soon as it
+gets found, followed by the full diffs.json report.
+"""
+
+import io
+import os
+import json
+import signal
+import asyncio
+import argparse
+import contextlib
+
+from playwright.async_api import async_playwright
+
+import shard
+import compare
+from client import DEFAULT_SOCKET
+from engine import DiffEngine
+
+
+class Server:
+	"""
+	Runs compare.py jobs using warm browsers and diff workers. Jobs run one
+	at a time, since compare.py keeps its run state in module globals.
+	"""
+
+	def __init__(self, p, engine):
+		self.p = p
+		self.engine = engine
+		self.lock = asyncio.Lock()
+
+	async def launch_browsers(self):
+		"""
+		(Re)launch any browser that isn't running (anymore).
+		"""
+		for browser_type in [self.p.chromium, self.p.firefox]:
+			browser = compare.warm_browsers.get(browser_type.name)
+			if browser is None or browser.is_connected() is False:
+				compare.warm_browsers[browser_type.name] = await browser_type.launch(headless=True)
+
+	async def close_browsers(self):
+		for browser in compare.warm_browsers.values():
+			await browser.close()
+		compare.warm_browsers.clear()
+
+	async def handle(self, reader, writer):
+		def send(message):
+			writer.write((json.dumps(message) + '\n').encode())
+
+		try:
+			job = json.loads(await reader.readline())
+			async with self.lock:
+				await self.run(job, send)
+		except Exception as e:
+			send({ 'error': f'{type(e).__name__}: {e}' })
+		finally:
+			await writer.drain()
+			writer.close()
+
+	async def run(self, job, send):
+		os.chdir(job['cwd'])
+
+		# argument errors (and --help) end in a SystemExit, with the reason
+		# printed, which we want to hand back to the client instead.
+		output = io.StringIO()
+		try:
+			with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+				compare.configure(job['argv'])
+		except SystemExit:
+			send({ 'error': output.getvalue().strip() })
+			return
+
+		if None in compare.url_list:
+			send({ 'error': 'No URL (or URL list) to compare.' })
+			return
+
+		await self.launch_browsers()
+		compare.result_listener = lambda key, entry: send({ 'key': key, 'failure': entry })
+		try:
+			report = await compare.capture_and_compare(self.p, self.engine) or {}
+		finally:
+			compare.result_listener = None
+
+		send({ 'report': report, 'failures': shard.count_failures(report) })
+
+
+async def serve(socket_path, workers):
+	async with async_playwright() as p, DiffEngine(workers) as engine:
+		print('Starting diff workers...')
+		await engine.warm_up()
+
+		print('Launching browsers...')
+		server = Server(p, engine)
+		await server.launch_browsers()
+
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+
+		unix_server = await asyncio.start_unix_server(server.handle, path=socket_path)
+		print(f'Listening on {socket_path}')
+
+		# make sure we get to clean up when asked to stop.
+		asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+
+		try:
+			async with unix_server:
+				await unix_server.serve_forever()
+		finally:
+			await server.close_browsers()
+			if os.path.exists(socket_path):
+				os.remove(socket_path)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Keep browsers and diff workers warm, and run the compare.py jobs that client.py sends.')
+	parser.add_argument('-dw', '--diff-workers', type=int, default=os.cpu_count(), help='Sets the number of diff worker processes. Defaults to the number of CPUs.')
+	parser.add_argument('--socket', default=DEFAULT_SOCKET, help=f'The socket to listen on. Defaults to {DEFAULT_SOCKET}.')
+	args = parser.parse_args()
+
+	try:
+		asyncio.run(serve(args.socket, args.diff_workers))
+	except (KeyboardInterrupt, asyncio.CancelledError):
+		pass
@@ -0,0 +1,127 @@
+"""
+Splitting a run across several machines: every (url path, browser, width)
+capture is a job, and jobs get partitioned over N shards such that each
+shard's expected run time is about the same, based on how long each job
+took last time (as recorded in a timings.json file), where known.
+
+The partitioning is deterministic, so every shard can work out which jobs
+are its own without needing to coordinate with the others, as long as they
+all start from the same timings file.
+"""
+
+import os
+import re
+import json
+
+
+TIMINGS_FILE = 'timings.json'
+
+
+def parse(spec):
+	"""
+	Turn an "i/N" shard spec into an (index, count) tuple, with the index
+	counting from 1, or raise a ValueError if the spec makes no sense.
+	"""
+	match = re.fullmatch(r'(\d+)/(\d+)', spec or '')
+	if match is None:
+		raise ValueError(f'{spec} is not of the form i/N')
+	(index, count) = (int(match.group(1)), int(match.group(2)))
+	if count < 1 or index < 1 or index > count:
+		raise ValueError(f'{spec} does not name one of 1/N through N/N')
+	return (index, count)
+
+
+def job_key(url_path, browser_name, width):
+	return f'{browser_name}-{width}/{url_path}'
+
+
+def load_timings(path):
+	if os.path.exists(path) is False:
+		return {}
+	with open(path, 'r') as timings:
+		return json.load(timings)
+
+
+def save_timings(path, timings):
+	"""
+	Merge new job timings (as a { job key: seconds } dict) into a timings file.
+	"""
+	merged = load_timings(path)
+	merged.update(timings)
+	with open(path, 'w') as file:
+		json.dump(merged, file, indent=2, sort_keys=True)
+
+
+def partition(jobs, count, timings=None):
+	"""
+	Spread (url path, browser, width) jobs over [count] shards, using the
+	longest-processing-time-first heuristic: the most expensive remaining job
+	always goes to the shard with the least work so far. Jobs we have no
+	timing for are assumed to take as long as the median job that we do
+	have a timing for. Returns a list of job sets, one per shard, along
+	with the expected run time for each shard.
+	"""
+	timings = timings or {}
+	known = sorted(timings.values())
+	fallback = known[len(known) // 2] if len(known) > 0 else 1.0
+
+	costed = [
+		(timings.get(job_key(*job), fallback), job_key(*job), job)
+		for job in jobs
+	]
+
+	# sort on the key as well, so equal-cost jobs always land in the same order.
+	costed.sort(key=lambda c: (-c[0], c[1]))
+
+	shards = [set() for _ in range(count)]
+	loads = [0.0] * count
+	for (cost, _, job) in costed:
+		target = min(range(count), key=lambda i: (loads[i], i))
+		shards[target].add(job)
+		loads[target] += cost
+
+	return shards, loads
+
+
+def merge_reports(reports):
+	"""
+	Combine the diffs.json reports of several shards into a single report.
+	Should shards have overlapped (e.g. because they did not all start from
+	the same timings file), only the first report's entry for a url is kept.
+	Nested groups of lists (like the "unchanged" pages) get merged the same way.
+	"""
+	merged = {}
+	for report in reports:
+		merge_into(merged, report)
+	return merged
+
+
+def merge_into(merged, report):
+	for (key, entries) in report.items():
+		if isinstance(entries, dict):
+			merge_into(merged.setdefault(key, {}), entries)
+			continue
+		target = merged.setdefault(key, [])
+		seen = set(entry_path(entry) for entry in target)
+		target.extend(entry for entry in entries if entry_path(entry) not in seen)
+
+
+def count_failures(report):
+	"""
+	The number of failures in a diffs.json report, which are the entries in
+	its "browser-width" lists (as opposed to, say, its unchanged pages).
+	"""
+	return sum(len(entries) for entries in report.values() if isinstance(entries, list))
+
+
+def exit_status(failures):
+	"""
+	The exit status for a run with this many failures: exit statuses only
+	go up to 255, and anything beyond that wraps around, so that a run with
+	exactly 256 failures would otherwise exit 0, and pass.
+	"""
+	return min(failures, 255)
+
+
+def entry_path(entry):
+	return entry if isinstance(entry, str) else entry['path']
@@ -0,0 +1,201 @@
+"""
+Tracing, for working out where the time in a run went. Spans get recorded
+as Chrome trace events, which can be loaded into chrome://tracing or
+https://ui.perfetto.dev, and can be summarised per stage.
+
+Tracing is off until enable() gets called, in which case span() does
+nothing beyond handing back its args. Spans recorded in diff workers are
+collected there (see run_traced), and added to the main process' trace.
+Timestamps come from time.perf_counter, which is system-wide on the
+platforms we run on, so spans from different processes line up.
+"""
+
+import os
+import json
+import math
+import time
+import asyncio
+import weakref
+import contextlib
+
+
+# the recorded trace events, or None when not tracing
+events = None
+
+# the trace "thread" for each asyncio task, see track()
+tracks = weakref.WeakKeyDictionary()
+
+
+def enable():
+	global events
+	events = []
+	tracks.clear()
+
+
+def disable():
+	global events
+	events = None
+
+
+def enabled():
+	return events is not None
+
+
+def now():
+	return time.perf_counter()
+
+
+def track():
+	"""
+	Every asyncio task gets its own track, so that the spans of tasks
+	running at the same time don't end up overlapping on a single track.
+	"""
+	try:
+		task = asyncio.current_task()
+	except RuntimeError:
+		task = None
+	if task is None:
+		return 0
+	if task not in tracks:
+		tracks[task] = len(tracks) + 1
+	return tracks[task]
+
+
+def complete(name, category, start, **args):
+	"""
+	Record a span that started at [start] (see now()) and ends right now.
+	"""
+	if events is None:
+		return
+	end = now()
+	events.append({
+		'name': name,
+		'cat': category,
+		'ph': 'X',
+		'ts': round(start * 1e6, 1),
+		'dur': round((end - start) * 1e6, 1),
+		'pid': os.getpid(),
+		'tid': track(),
+		'args': args,
+	})
+
+
+def counter(name, **values):
+	"""
+	Record the current value(s) of something that changes over time.
+	"""
+	if events is None:
+		return
+	events.append({
+		'name': name,
+		'ph': 'C',
+		'ts': round(now() * 1e6, 1),
+		'pid': os.getpid(),
+		'args': values,
+	})
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+	"""
+	Record a span for whatever runs inside this context. The args dict
+	gets yielded, so that results (like region counts) can be added to it.
+	"""
+	if events is None:
+		yield args
+		return
+	start = now()
+	try:
+		yield args
+	finally:
+		complete(name, category, start, **args)
+
+
+def collect():
+	"""
+	Take all events recorded so far.
+	"""
+	global events
+	if events is None:
+		return []
+	(collected, events) = (events, [])
+	return collected
+
+
+def add(more):
+	if events is not None:
+		events.extend(more)
+
+
+def run_traced(label, fn, *args, **kwargs):
+	"""
+	Run a function with tracing enabled, in a (diff worker) process that
+	isn't tracing otherwise, returning its result along with its events.
+	"""
+	enable()
+	try:
+		with span(fn.__name__, 'worker', label=label):
+			result = fn(*args, **kwargs)
+		return result, collect()
+	finally:
+		disable()
+
+
+def percentile(values, p):
+	# nearest rank, on sorted values
+	return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summary(trace_events, slowest=10):
+	"""
+	Summarise trace events as text: the count, total, p50, p95 and max
+	duration for every kind of span, followed by the slowest captures and
+	the slowest diffs.
+	"""
+	spans = [event for event in trace_events if event['ph'] == 'X']
+	stages = {}
+	for event in spans:
+		stages.setdefault((event['cat'], event['name']), []).append(event['dur'] / 1000)
+
+	lines = [f'{"stage":<32}{"count":>8}{"total (s)":>12}{"p50 (ms)":>12}{"p95 (ms)":>12}{"max (ms)":>12}']
+	for ((category, name), durations) in sorted(stages.items()):
+		durations.sort()
+		lines.append(
+			f'{category + "/" + name:<32}{len(durations):>8}{sum(durations) / 1000:>12.2f}'
+			f'{percentile(durations, 50):>12.1f}{percentile(durations, 95):>12.1f}{durations[-1]:>12.1f}'
+		)
+
+	for (name, title) in [('capture', 'Slowest captures'), ('diff', 'Slowest diffs')]:
+		spans = sorted(
+			(e for e in spans if e['name'] == name and 'url' in e['args']),
+			key=lambda e: e['dur'],
+			reverse=True
+		)[:slowest]
+		if len(spans) == 0:
+			continue
+		lines.append('')
+		lines.append(f'{title}:')
+		for e in spans:
+			where = ', '.join(f'{k}={v}' for (k, v) in e['args'].items() if k != 'url')
+			lines.append(f'- {e["args"]["url"]} ({where}): {e["dur"] / 1e6:.2f}s')
+
+	return '\n'.join(lines)
+
+
+def save(path, trace_events):
+	"""
+	Write trace events as a Chrome trace file, naming the processes they
+	came from: our own, and the diff workers.
+	"""
+	pids = sorted(set(event['pid'] for event in trace_events) | {os.getpid()})
+	names = [
+		{
+			'name': 'process_name',
+			'ph': 'M',
+			'pid': pid,
+			'args': { 'name': 'main' if pid == os.getpid() else f'diff worker {pid}' },
+		}
+		for pid in pids
+	]
+	with open(path, 'w') as file:
+		json.dump({ 'traceEvents': names + trace_events, 'displayTimeUnit': 'ms' }, file)
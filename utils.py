@@ -2,14 +2,19 @@
 Diffing requirements:
 
 - opencv-python
-- scikit-image
 - imutils
 """
 
+import bisect
+import hashlib
+
+from collections import Counter
+
 import cv2
 import numpy as np
 import imutils
-from skimage.metrics import structural_similarity
+
+import tracing
 
 
 BLACK = (0,0,0)
@@ -20,6 +25,40 @@ BLUE = (255,0,0)
 
 SUPPRESS_LOGGING = False
 
+# The SSIM window size and constants, matching the defaults for
+# scikit-image's structural_similarity on 8 bit images. The window
+# size also tells us how much overlap bands need in order to yield
+# the same result as a full-image comparison.
+SSIM_WINDOW = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+# How many rows of an image get run through SSIM at a time.
+SSIM_BLOCK_ROWS = 1024
+
+# Row alignment: runs of matching rows shorter than this are not
+# considered meaningful alignment.
+MIN_ALIGNED_ROWS = 8
+
+# Relocation search: how many times the original may get halved (along
+# either axis) for the coarse search, how small a (downscaled) diff region
+# may get before it stops being useful to match on, both per side and in
+# area, how many coarse matches get refined at full resolution, and how
+# many candidates the exact search verifies (per block of this many rows)
+# if none of those matched.
+PYRAMID_LEVELS = 3
+MIN_TEMPLATE_SIDE = 6
+MIN_TEMPLATE_SIZE = 12
+RELOCATION_CANDIDATES = 5
+EXACT_CANDIDATES = 256
+EXACT_BLOCK_ROWS = 2048
+
+# Thumbnails: how wide the whole-page thumbnails get, how much context
+# goes around each diff region crop, and how big those crops may get.
+THUMBNAIL_WIDTH = 320
+CROP_PADDING = 24
+CROP_MAX_SIZE = 480
+
 def log_info(*args):
 	if SUPPRESS_LOGGING is True:
 		return
@@ -39,78 +78,413 @@ def loadImage(path):
 		raise ValueError("please use: diff.py [filename] [filename]")
 
 
+def decodeImage(data):
+	"""
+	Decode an in-memory (PNG) image, or explain why that wasn't possible
+	"""
+	image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+	if image is None:
+		raise ValueError('screenshot data could not be decoded as an image')
+	return image
+
+
+def pixel_hash(img):
+	"""
+	Hash the decoded pixel data (and shape) of an image, so that identical
+	renders hash the same no matter how their PNGs were encoded.
+	"""
+	h = hashlib.blake2b(digest_size=16)
+	h.update(str(img.shape).encode())
+	h.update(np.ascontiguousarray(img).data)
+	return h.hexdigest()
+
+
+def window_mean(img):
+	return cv2.boxFilter(img, -1, (SSIM_WINDOW, SSIM_WINDOW), borderType=cv2.BORDER_REFLECT)
+
+
+def ssim_map(img1, img2):
+	"""
+	Compute the SSIM map for an image pair, the same way scikit-image's
+	structural_similarity does with its default uniform window, but using
+	float32 box filters, reusing buffers wherever possible. Images with
+	multiple channels get compared per channel, in a single pass.
+	"""
+	x = img1.astype(np.float32)
+	y = img2.astype(np.float32)
+	n = SSIM_WINDOW * SSIM_WINDOW
+	cov_norm = n / (n - 1)
+
+	ux = window_mean(x)
+	uy = window_mean(y)
+
+	# (co)variances, reusing the input buffers once we no longer need them
+	tmp = x * y
+	vxy = window_mean(tmp)
+	np.multiply(ux, uy, out=tmp)
+	vxy -= tmp
+	np.multiply(x, x, out=x)
+	vx = window_mean(x)
+	np.multiply(ux, ux, out=tmp)
+	vx -= tmp
+	np.multiply(y, y, out=y)
+	vy = window_mean(y)
+	np.multiply(uy, uy, out=tmp)
+	vy -= tmp
+	del x, y
+
+	# S = (2 ux uy + C1)(2 vxy + C2) / ((ux² + uy² + C1)(vx + vy + C2))
+	vx += vy
+	vx *= cov_norm
+	vx += SSIM_C2
+	vxy *= 2 * cov_norm
+	vxy += SSIM_C2
+	tmp += SSIM_C1
+	np.multiply(ux, ux, out=vy)
+	tmp += vy
+	ux *= uy
+	ux *= 2
+	ux += SSIM_C1
+	ux *= vxy
+	vx *= tmp
+	ux /= vx
+	return ux
+
+
 def compare(how, img1, img2):
 	"""
-	Perform SSIM and find diff contours on the result
+	Perform SSIM, in blocks of rows (with enough overlap to give the same
+	result as a single pass over the whole image) so that the float32
+	intermediates never need to exist for more than one block at a time.
+	Returns the mean SSIM (per channel) and the SSIM map scaled to uint8.
 	"""
+	(height, width) = img1.shape[:2]
+	pad = (SSIM_WINDOW - 1) // 2
+	diff = np.empty(img1.shape, dtype="uint8")
+	total = 0
+
+	for y1 in range(0, height, SSIM_BLOCK_ROWS):
+		y2 = min(y1 + SSIM_BLOCK_ROWS, height)
+		t1 = max(0, y1 - SSIM_WINDOW)
+		t2 = min(height, y2 + SSIM_WINDOW)
+		ssim = ssim_map(img1[t1:t2], img2[t1:t2])[y1 - t1:y2 - t1]
+
+		# the score only covers the part of the map that isn't affected by the image border
+		(r1, r2) = (max(y1, pad), min(y2, height - pad))
+		if r2 > r1:
+			total += ssim[r1 - y1:r2 - y1, pad:width - pad].sum(axis=(0, 1), dtype=np.float64)
 
-	# full=True gives us both the similarity score and the diff map
-	score, diff = structural_similarity(img1, img2, full=True)
-	diff = (diff * 255).astype("uint8")
+		ssim *= 255
+		np.clip(ssim, 0, 255, out=ssim)
+		diff[y1:y2] = ssim
+
+	score = total / ((height - 2 * pad) * (width - 2 * pad))
 
 	#cv2.namedWindow(f'{how} diff', cv2.WINDOW_NORMAL)
 	#cv2.imshow(f'{how} diff', diff)
 	#cv2.waitKey(0)
 
-	return diff
+	return score, diff
+
+
+def dirty_bands(a, b, band_height):
+	"""
+	Split an image pair into horizontal bands, and return the [y1, y2)
+	ranges for the bands that are not byte-for-byte identical. Because SSIM
+	windows reach across band edges, a band also counts as changed when
+	the rows just outside of it changed.
+	"""
+	height = a.shape[0]
+	bands = []
+	for y1 in range(0, height, band_height):
+		y2 = min(y1 + band_height, height)
+		t1 = max(0, y1 - SSIM_WINDOW)
+		t2 = min(height, y2 + SSIM_WINDOW)
+		if not np.array_equal(a[t1:t2], b[t1:t2]):
+			bands.append((y1, y2))
+	return bands
+
+
+def compare_tiled(how, a, b, bands):
+	"""
+	Perform SSIM on only the changed bands of an image pair, stitching the
+	results into a full-size diff map in which the unchanged bands count as
+	identical. Bands are compared with enough overlap that the diff map is the
+	same as for a full-image comparison, so that the work done scales with the
+	size of the change rather than the size of the page. The score is the mean
+	of the band scores, weighted by band height.
+	"""
+	height = a.shape[0]
+	diff = np.full(a.shape, 255, dtype="uint8")
+	dissimilarity = 0
+
+	for (y1, y2) in bands:
+		t1 = max(0, y1 - SSIM_WINDOW)
+		t2 = min(height, y2 + SSIM_WINDOW)
+		score, band = compare(how, a[t1:t2], b[t1:t2])
+		diff[y1:y2] = band[y1 - t1:y2 - t1]
+		dissimilarity += (1 - score) * (y2 - y1)
+
+	return 1 - dissimilarity / height, diff
+
+
+def row_hashes(img):
+	"""
+	Hash every pixel row of an image, so that rows can be matched up
+	between images without comparing them pixel by pixel.
+	"""
+	rows = np.ascontiguousarray(img).reshape(img.shape[0], -1)
+	return [
+		int.from_bytes(hashlib.blake2b(row.data, digest_size=8).digest(), 'little')
+		for row in rows
+	]
+
+
+def increasing_pairs(pairs):
+	"""
+	Find the longest run of (i, j) pairs, with i already increasing,
+	for which j is increasing as well.
+	"""
+	tails = []
+	tail_indices = []
+	previous = [None] * len(pairs)
+	for (n, (i, j)) in enumerate(pairs):
+		k = bisect.bisect_left(tails, j)
+		if k > 0:
+			previous[n] = tail_indices[k - 1]
+		if k == len(tails):
+			tails.append(j)
+			tail_indices.append(n)
+		else:
+			tails[k] = j
+			tail_indices[k] = n
+
+	run = []
+	n = tail_indices[-1] if len(tail_indices) > 0 else None
+	while n is not None:
+		run.append(pairs[n])
+		n = previous[n]
+	return run[::-1]
+
+
+def match_rows(ha, hb, a0, a1, b0, b1, matches):
+	"""
+	Patience-style row matching: match up the rows at the start and end of
+	a stretch directly, then use the rows that occur exactly once in both
+	images as anchors and recurse into the stretches between them. Unlike
+	a general LCS, this stays fast for pages with lots of repeated (blank)
+	rows. Matched (i, j) row pairs get added to the matches list, in order.
+	"""
+	while a0 < a1 and b0 < b1 and ha[a0] == hb[b0]:
+		matches.append((a0, b0))
+		a0 += 1
+		b0 += 1
+
+	tail = []
+	while a0 < a1 and b0 < b1 and ha[a1 - 1] == hb[b1 - 1]:
+		a1 -= 1
+		b1 -= 1
+		tail.append((a1, b1))
+
+	if a0 < a1 and b0 < b1:
+		counts_a = Counter(ha[a0:a1])
+		counts_b = Counter(hb[b0:b1])
+		unique_b = { hb[j]: j for j in range(b0, b1) if counts_b[hb[j]] == 1 }
+		anchors = increasing_pairs([
+			(i, unique_b[ha[i]])
+			for i in range(a0, a1)
+			if counts_a[ha[i]] == 1 and ha[i] in unique_b
+		])
+
+		(i0, j0) = (a0, b0)
+		for (i, j) in anchors:
+			match_rows(ha, hb, i0, i, j0, j, matches)
+			matches.append((i, j))
+			(i0, j0) = (i + 1, j + 1)
+		if len(anchors) > 0:
+			match_rows(ha, hb, i0, a1, j0, b1, matches)
+
+	matches.extend(tail[::-1])
+
+
+def align_rows(a, b, rows_a=None):
+	"""
+	Work out which rows in b correspond to which rows in a, so that content
+	that got pushed down (or pulled up) by an insertion (or deletion) lines
+	up again. This yields difflib-style (tag, i1, i2, j1, j2) opcodes, for
+	"equal", "insert", "delete" and "replace" blocks of rows. The row hashes
+	for a can be passed in, if they're already known.
+	"""
+	ha = row_hashes(a) if rows_a is None else rows_a
+	hb = row_hashes(b)
+	(na, nb) = (len(ha), len(hb))
+
+	matches = []
+	match_rows(ha, hb, 0, na, 0, nb, matches)
+
+	opcodes = []
+	(i0, j0) = (0, 0)
+	for (i, j) in matches:
+		if i > i0 or j > j0:
+			opcodes.append(('replace', i0, i, j0, j))
+		if len(opcodes) > 0 and opcodes[-1][0] == 'equal' and opcodes[-1][2] == i and opcodes[-1][4] == j:
+			(_, i1, _, j1, _) = opcodes.pop()
+			opcodes.append(('equal', i1, i + 1, j1, j + 1))
+		else:
+			opcodes.append(('equal', i, i + 1, j, j + 1))
+		(i0, j0) = (i + 1, j + 1)
+	if na > i0 or nb > j0:
+		opcodes.append(('replace', i0, na, j0, nb))
+
+	return merge_opcodes(opcodes)
+
+
+def merge_opcodes(opcodes):
+	"""
+	Fold runs of matching rows that are too short to be meaningful (like a
+	single blank row) into their neighbouring changes, and merge adjacent
+	changes into single blocks.
+	"""
+	merged = []
+	for (tag, i1, i2, j1, j2) in opcodes:
+		if tag == 'equal' and i2 - i1 < MIN_ALIGNED_ROWS and len(merged) > 0:
+			tag = 'replace'
+		if tag != 'equal' and len(merged) > 0 and merged[-1][0] != 'equal':
+			(_, pi1, _, pj1, _) = merged.pop()
+			(i1, j1) = (pi1, pj1)
+		if tag != 'equal':
+			tag = 'insert' if i1 == i2 else 'delete' if j1 == j2 else 'replace'
+		merged.append((tag, i1, i2, j1, j2))
+	return merged
+
+
+def unique_boxes(boxes):
+	"""
+	Remove duplicate boxes from an (N, 4) array, keeping the first occurrence.
+	"""
+	if len(boxes) == 0:
+		return boxes
+	_, first = np.unique(boxes, axis=0, return_index=True)
+	return boxes[np.sort(first)]
+
+
+def classify_boxes(boxes):
+	"""
+	Split an (N, 4) array of [x1, y1, x2, y2] boxes into regular and tiny
+	diff boxes, throwing away the ones that are too small to matter.
+	"""
+	w = boxes[:, 2] - boxes[:, 0]
+	h = boxes[:, 3] - boxes[:, 1]
+	small = (w <= 15) | (h <= 15)
+	# note: anything smaller than 7x7 is just straight up not a meaningful
+	# difference, and could be JPG artifacting, text subpixel anti-aliassing,
+	# or any number of other "not real diff" causes. The odds that a 5x5 or
+	# smaller diff is because of a genuine change in HTML or CSS is so low that
+	# the cost of evaluating every one of them is just not worth calling out.
+	meaningless = (w < 7) & (h < 7)
+	return boxes[~small], boxes[small & ~meaningless]
+
 
+def extract_contours(diff, diffs=None, tinydiffs=None):
+	# note: these can't be default list arguments, because diff workers are
+	# long-lived processes and would keep accumulating regions across pairs.
+	diffs = [] if diffs is None else diffs
+	tinydiffs = [] if tinydiffs is None else tinydiffs
 
-def extract_contours(diff, diffs=[], tinydiffs=[]):
 	# find our contours
 	thresh = cv2.threshold(diff, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)[1]
 	contours = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 	contours = imutils.grab_contours(contours)
 
 	# aggregate the contours, throwing away duplicates
-	for c in contours:
-		(x, y, w, h) = cv2.boundingRect(c)
-		region = [x, y, x + w, y + h]
-		if w <= 15 or h <= 15:
-			# note: anything smaller than 7x7 is just straight up not a meaningful
-			# difference, and could be JPG artifacting, text subpixel anti-aliassing,
-			# or any number of other "not real diff" causes. The odds that a 5x5 or
-			# smaller diff is because of a genuine change in HTML or CSS is so low that
-			# the cost of evaluating every one of them is just not worth calling out.
-			if w < 7 and h < 7:
-				continue
-			try:
-				tinydiffs.index(region)
-			except ValueError:
-				tinydiffs.append(region)
-		else:
-			try:
-				diffs.index(region)
-			except ValueError:
-				diffs.append(region)
+	rects = np.array([cv2.boundingRect(c) for c in contours], dtype=np.int64).reshape(-1, 4)
+	rects[:, 2:] += rects[:, :2]
+	(regular, tiny) = classify_boxes(rects)
 
-	return diffs, tinydiffs
+	diffs = unique_boxes(np.array(diffs + regular.tolist(), dtype=np.int64).reshape(-1, 4))
+	tinydiffs = unique_boxes(np.array(tinydiffs + tiny.tolist(), dtype=np.int64).reshape(-1, 4))
+	return diffs.tolist(), tinydiffs.tolist()
 
 
 def filter_diffs(diffs):
 	"""
-	This is inefficient, but cv2.RETR_EXTERNAL should have already removed
-	all contours contained by other contours... but it hasn't. So we do this.
+	cv2.RETR_EXTERNAL should have already removed all contours contained
+	by other contours... but it hasn't. So we remove every box that is
+	strictly contained by another box. This is done in chunks, to keep
+	the (chunk, N) comparison matrices small.
 	"""
-	def not_contained(e, diffs):
-		for t in diffs:
-			if e[0] > t[0] and e[2] < t[2] and e[1] > t[1] and e[3] < t[3]:
-				return False
-		return True
+	boxes = np.array(diffs, dtype=np.int64).reshape(-1, 4)
+	contained = np.zeros(len(boxes), dtype=bool)
+	for start in range(0, len(boxes), 1024):
+		e = boxes[start:start + 1024, None, :]
+		t = boxes[None, :, :]
+		inside = (e[..., 0] > t[..., 0]) & (e[..., 2] < t[..., 2]) & (e[..., 1] > t[..., 1]) & (e[..., 3] < t[..., 3])
+		contained[start:start + 1024] = inside.any(axis=1)
+	return boxes[~contained].tolist()
 
-	return [e for e in diffs if not_contained(e, diffs)]
+
+def find_root(parents, i):
+	while parents[i] != i:
+		parents[i] = parents[parents[i]]
+		i = parents[i]
+	return i
 
 
 def collapse_diffs(a, diffs, tolerance=1):
 	"""
-	draw all diffs, dilated by [tolerance], then re-compute the resulting contours
+	Merge all diffs that touch or overlap once dilated by [tolerance], which
+	yields the same regions as drawing the dilated diffs onto a blank canvas
+	and re-computing the resulting contours, without any of the drawing.
 	"""
-	canvas = a.copy()
-	(w,h,channels) = canvas.shape
-	cv2.rectangle(canvas, (0,0), (w,h), WHITE, cv2.FILLED)
-	for d in diffs:
-		cv2.rectangle(canvas, (d[0] - tolerance, d[1] - tolerance), (d[2] + tolerance, d[3] + tolerance), BLACK, cv2.FILLED)
-	diffs, tinydiffs = extract_contours(gray(canvas))
-	return filter_diffs(diffs)
+	(height, width) = a.shape[:2]
+
+	# the (inclusive) pixel extents of the dilated boxes, as they would get drawn
+	boxes = np.array(diffs, dtype=np.int64).reshape(-1, 4)
+	boxes[:, :2] -= tolerance
+	boxes[:, 2:] += tolerance
+	boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, width - 1)
+	boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, height - 1)
+
+	# sweep over the boxes from left to right, joining every box with the
+	# boxes that start before it ends (plus one, because pixels that touch,
+	# even diagonally, are part of the same contour) and that overlap or
+	# touch it vertically.
+	order = np.argsort(boxes[:, 0], kind='stable')
+	boxes = boxes[order]
+	parents = list(range(len(boxes)))
+	x1 = boxes[:, 0]
+	for i in range(len(boxes)):
+		end = np.searchsorted(x1, boxes[i, 2] + 1, side='right')
+		candidates = np.arange(i + 1, end)
+		touching = candidates[
+			(boxes[candidates, 1] <= boxes[i, 3] + 1) & (boxes[candidates, 3] >= boxes[i, 1] - 1)
+		]
+		for j in touching:
+			(ri, rj) = (find_root(parents, i), find_root(parents, j))
+			if ri != rj:
+				parents[rj] = ri
+
+	# the bounding box for each group of joined boxes
+	roots = np.array([find_root(parents, i) for i in range(len(boxes))])
+	(groups, group) = np.unique(roots, return_inverse=True)
+	merged = np.empty((len(groups), 4), dtype=np.int64)
+	merged[:, :2] = np.iinfo(np.int64).max
+	merged[:, 2:] = np.iinfo(np.int64).min
+	np.minimum.at(merged[:, 0], group, boxes[:, 0])
+	np.minimum.at(merged[:, 1], group, boxes[:, 1])
+	np.maximum.at(merged[:, 2], group, boxes[:, 2] + 1)
+	np.maximum.at(merged[:, 3], group, boxes[:, 3] + 1)
+
+	# order the merged regions the way cv2.findContours would have found them:
+	# by the first pixel of each region in raster order, last one first.
+	first = np.full((len(groups), 2), np.iinfo(np.int64).max, dtype=np.int64)
+	top_row = merged[group, 1] == boxes[:, 1]
+	np.minimum.at(first[:, 1], group[top_row], boxes[top_row, 0])
+	first[:, 0] = merged[:, 1]
+	merged = merged[np.lexsort((first[:, 1], first[:, 0]))[::-1]]
+
+	(regular, tiny) = classify_boxes(merged)
+	return filter_diffs(regular.tolist())
 
 
 def mse_similarity(a, b):
@@ -125,10 +499,168 @@ def get_distance(x1,y1,x2,y2):
 	return (dx*dx + dy*dy) ** 0.5
 
 
-def find_in_original(a, b, area):
+def build_pyramid(img):
+	"""
+	A cache of downscaled versions of an image (see scaled), keyed on
+	their horizontal and vertical scale, for the coarse relocation search.
+	These only get made when first needed.
+	"""
+	return { (1, 1): img }
+
+
+def scaled(pyramid, sx, sy):
+	"""
+	The pyramid's image, downscaled sx times horizontally and sy times vertically.
+	"""
+	if (sx, sy) not in pyramid:
+		img = pyramid[(1, 1)]
+		size = (max(1, img.shape[1] // sx), max(1, img.shape[0] // sy))
+		pyramid[(sx, sy)] = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+	return pyramid[(sx, sy)]
+
+
+def template_scales(w, h):
+	"""
+	How far to downscale a w x h template horizontally and vertically for
+	the coarse search: keep halving whichever side is currently the larger,
+	for as long as the template stays big enough to match on. Thin regions,
+	like a line of text, can still be downscaled along their long side.
+	"""
+	(sx, sy) = (1, 1)
+	while True:
+		options = [(sx * 2, sy), (sx, sy * 2)]
+		if h // sy > w // sx:
+			options.reverse()
+		options = [
+			(x, y) for (x, y) in options
+			if max(x, y) <= 2 ** PYRAMID_LEVELS
+			and w // x >= MIN_TEMPLATE_SIDE and h // y >= MIN_TEMPLATE_SIDE
+			and (w // x) * (h // y) >= MIN_TEMPLATE_SIZE ** 2
+		]
+		if len(options) == 0:
+			return (sx, sy)
+		(sx, sy) = options[0]
+
+
+def best_matches(img, template, count=1):
+	"""
+	Find the [count] best (non-overlapping) matches for a template in an
+	image, as (score, (x, y)) tuples.
+	"""
+	result = cv2.matchTemplate(img, template, cv2.TM_CCOEFF_NORMED)
+	(h, w) = template.shape[:2]
+	matches = []
+	for _ in range(count):
+		min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
+		matches.append((max_val, max_loc))
+		# suppress this match's neighbourhood so the next one is a different match
+		(x, y) = max_loc
+		result[max(0, y - h // 2):y + h // 2 + 1, max(0, x - w // 2):x + w // 2 + 1] = -2
+	return matches
+
+
+def window_sums(img, w, h):
+	"""
+	The sums of the first channel over every h x w window in an image, via
+	a summed-area table. This uses wrapping uint32 arithmetic, which is fine:
+	it's only used to rule out locations, and equal windows still always sum
+	to the same value.
+	"""
+	sums = np.zeros((img.shape[0] + 1, img.shape[1] + 1), dtype=np.uint32)
+	np.cumsum(img[:, :, 0], axis=0, dtype=np.uint32, out=sums[1:, 1:])
+	np.cumsum(sums, axis=1, dtype=np.uint32, out=sums)
+	windows = sums[h:, w:] - sums[:-h, w:]
+	windows -= sums[h:, :-w]
+	windows += sums[:-h, :-w]
+	return windows
+
+
+def exact_location(a, crop, area, top, bottom):
+	"""
+	Find a location in the rows top through bottom of a that exactly
+	matches the crop, at full resolution: only the locations whose window
+	sum matches the crop's are checked. This works through blocks of rows,
+	nearest to the area first, checking locations closest to the area first.
+	"""
+	(h, w) = crop.shape[:2]
+	target = np.uint32(int(crop[:, :, 0].sum()) & 0xFFFFFFFF)
+
+	blocks = range(top, bottom - h + 1, EXACT_BLOCK_ROWS)
+	for start in sorted(blocks, key=lambda start: abs(start + EXACT_BLOCK_ROWS // 2 - area[1])):
+		end = min(start + EXACT_BLOCK_ROWS, bottom - h + 1)
+		windows = window_sums(a[start:end + h - 1], w, h)
+		(ys, xs) = np.nonzero(windows == target)
+
+		distance = (xs - area[0]) ** 2 + (ys + start - area[1]) ** 2
+		for i in np.argsort(distance, kind='stable')[:EXACT_CANDIDATES]:
+			(x, y) = (int(xs[i]), int(ys[i]) + start)
+			if np.array_equal(a[y:y + h, x:x + w], crop):
+				return (x, y)
+
+	return None
+
+
+def locate_in(a, crop, area, pyramid=None, search_band=0):
+	"""
+	Find a location in a that exactly matches the crop, or None if there
+	isn't one. We search a downscaled version of a first, refining only
+	the best few coarse matches at full resolution, and only if none of
+	those is an exact match do we fall back to an exhaustive (but cheap,
+	see exact_location) full resolution search. If a search band is
+	given, only the rows within that distance from the area are searched.
+	"""
+	(h, w) = crop.shape[:2]
+	(height, width) = a.shape[:2]
+
+	(top, bottom) = (0, height)
+	if search_band > 0:
+		top = max(0, area[1] - search_band)
+		bottom = min(height, area[3] + search_band)
+	if bottom - top < h or width < w:
+		(top, bottom) = (0, height)
+		if height < h or width < w:
+			return None
+
+	pyramid = pyramid or build_pyramid(a)
+	(sx, sy) = template_scales(w, h)
+
+	if (sx, sy) != (1, 1):
+		coarse = scaled(pyramid, sx, sy)[top // sy:-(-bottom // sy)]
+		coarse_crop = cv2.resize(crop, (w // sx, h // sy), interpolation=cv2.INTER_AREA)
+
+		if coarse.shape[0] >= coarse_crop.shape[0] and coarse.shape[1] >= coarse_crop.shape[1]:
+			for (value, (x, y)) in best_matches(coarse, coarse_crop, RELOCATION_CANDIDATES):
+				x = x * sx
+				y = (y + top // sy) * sy
+				(mx, my) = (2 * sx, 2 * sy)
+				(x1, y1) = (max(0, x - mx), max(top, y - my))
+				(x2, y2) = (min(width, x + w + mx), min(bottom, y + h + my))
+				if x2 - x1 < w or y2 - y1 < h:
+					continue
+				(value, (fx, fy)) = best_matches(a[y1:y2, x1:x2], crop)[0]
+				(fx, fy) = (x1 + fx, y1 + fy)
+				if np.array_equal(a[fy:fy + h, fx:fx + w], crop):
+					return (fx, fy)
+
+	return exact_location(a, crop, area, top, bottom)
+
+
+def find_in_original(a, b, area, pyramid=None, search_band=0):
 	"""
 	See if we can find a diff area in the original, because it's possible
 	it simply moved around wholesale, rather than being a changed region.
+	Pass in build_pyramid(a) when calling this for more than one area.
+	"""
+	location = locate_origin(a, b, area, pyramid, search_band)
+	if location is None:
+		return None
+	return origin_at(a, b, area, location)
+
+
+def locate_origin(a, b, area, pyramid=None, search_band=0):
+	"""
+	Find the box in the original that exactly matches a diff area in the
+	new image, or None if there isn't one.
 	"""
 	w = (area[2] - area[0])
 	h = (area[3] - area[1])
@@ -139,14 +671,29 @@ def find_in_original(a, b, area):
 		return None
 
 	crop = b[area[1]:area[3], area[0]:area[2]]
-	result = cv2.matchTemplate(crop, a, cv2.TM_CCOEFF_NORMED)
+	location = locate_in(a, crop, area, pyramid, search_band)
+	if location is None:
+		return None
+
+	(startX, startY) = location
+	return [startX, startY, startX + w, startY + h]
 
-	min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(result)
-	(startX, startY) = max_loc
 
-	(endX, endY) = (startX + w, startY + h)
-	endX = startX + w
-	endY = startY + h
+def origin_at(a, b, area, location):
+	"""
+	Check whether a diff area's content is found, unchanged, at the given
+	box in the original: returns that box if it is, an empty list if that
+	box is also the same in the new image (a "noop"), and None otherwise.
+	"""
+	(startX, startY, endX, endY) = location
+	w = (area[2] - area[0])
+	h = (area[3] - area[1])
+
+	if startX < 0 or startY < 0 or endX > a.shape[1] or endY > a.shape[0]:
+		# the box (partially) falls outside of the original.
+		return None
+
+	crop = b[area[1]:area[3], area[0]:area[2]]
 	ocrop = a[startY:endY, startX:endX]
 	region = None
 
@@ -166,27 +713,60 @@ def find_in_original(a, b, area):
 	return region
 
 
-def highlight_diffs(a, b, diffs, write=False, result_path='results', match_origin=False):
+def highlight_diffs(a, b, diffs, write=False, result_path='results', match_origin=False, removed=None, search_band=0, masks=True, known_regions=None, inserted=None):
 	"""
 	Show diff using red highlights for "true diffs", and blue highlights for relocated content.
+	Content that was removed from the original gets highlighted in the original instead.
+
+	Returns the highlighted regions as a list of { kind, box } dicts, with kind one of
+	"diff" or "relocated" (boxes in the new image, with relocations also listing their
+	origin box in the original), or "removed" (boxes in the original). When writing
+	results without masks, the regions are all we produce, and no mask images get made.
+
+	When given a dict of known regions (see region_hash and relative_origin), every
+	region also lists its hash as its "cluster", and regions we already know the
+	origin for skip the relocation search, as long as their content is found at
+	that same origin in this page's original, too. New origins get added to the dict.
+	Diffs that are listed as inserted content (see aligned_diff_regions) only hash
+	their new pixels, the same way removed regions only hash their old pixels.
 	"""
+	regions = []
+
+	# the (downscaled) originals we search for relocated content in
+	pyramid = build_pyramid(a) if match_origin else None
+
+	if write is False:
+		masks = True
 
 	# If there are "relocations" we want to highlight those in the original image
-	original_mask = a.copy()
-	original_mask[:] = (255, 255, 255)
+	original_mask = np.full(a.shape, 255, dtype=np.uint8) if masks else None
 
 	# For non-relocation diffs we build a mask, instead.
-	diff_mask = b.copy()
-	diff_mask[:] = (255, 255, 255)
+	diff_mask = np.full(b.shape, 255, dtype=np.uint8) if masks else None
 
 	for num, area in enumerate(diffs):
 		log_info(f'processing diff {num+1} (bbox={area})')
 		x1, y1, x2, y2 = area
 		origin = None
+		kind = 'inserted' if area in (inserted or []) else 'changed'
+		digest = None if known_regions is None else region_hash(a, b, area, kind)
+
+		count = len(regions)
 
 		if match_origin:
-			# is this a relocation, or an addition/deletion?
-			origin = find_in_original(a, b, area)
+			known = digest in (known_regions or {})
+			if known and known_regions[digest] is not None:
+				# we've already seen this exact change, on another page, so
+				# check its content is in the same spot relative to it here.
+				origin = origin_at(a, b, area, absolute_origin(known_regions[digest], area))
+			if origin is None and not (known and known_regions[digest] is None):
+				# is this a relocation, or an addition/deletion?
+				with tracing.span('relocate', 'diff', box=f'{x2 - x1}x{y2 - y1}'):
+					location = locate_origin(a, b, area, pyramid, search_band)
+					origin = None if location is None else origin_at(a, b, area, location)
+				if digest is not None:
+					known_regions[digest] = relative_origin(location, area)
+
 			if origin is not None:
 				if len(origin) == 0:
 					# this region was effectively a "noop": it's an area that got flagged
@@ -198,27 +778,152 @@ def highlight_diffs(a, b, diffs, write=False, result_path='results', match_origi
 					# If we found this new content somewhere in the old content (with a high
 					# enough confidence) then this is content that got moved rather than being
 					# content that got changed.
-					cv2.rectangle(original_mask, (origin[0], origin[1]), (origin[2], origin[3]), BLUE, cv2.FILLED)
-					cv2.rectangle(diff_mask, (x1, y1), (x2, y2), BLUE, cv2.FILLED)
+					regions.append(region('relocated', area, origin))
 			else:
 				# If we cannot find this new content in the old content, this
 				# is a regular old "diff" in that this region of the image has
 				# just changed (for whatever reason)
-				cv2.rectangle(diff_mask, (x1, y1), (x2, y2), GREEN, cv2.FILLED)
+				regions.append(region('diff', area))
 		else:
 			# Same case as when match_origin can't find matches:
-			cv2.rectangle(diff_mask, (x1, y1), (x2, y2), GREEN, cv2.FILLED)
+			regions.append(region('diff', area))
+
+		if digest is not None and len(regions) > count:
+			regions[-1]['cluster'] = digest
+
+	for area in (removed or []):
+		regions.append(region('removed', area))
+		if known_regions is not None:
+			regions[-1]['cluster'] = region_hash(a, b, area, 'removed')
 
 	log_info('diff pass complete')
 
+	if masks is False:
+		return regions
+
+	for r in regions:
+		(x1, y1, x2, y2) = r['box']
+		if r['kind'] == 'relocated':
+			(o1, p1, o2, p2) = r['origin']
+			cv2.rectangle(original_mask, (o1, p1), (o2, p2), BLUE, cv2.FILLED)
+			cv2.rectangle(diff_mask, (x1, y1), (x2, y2), BLUE, cv2.FILLED)
+		elif r['kind'] == 'removed':
+			cv2.rectangle(original_mask, (x1, y1), (x2, y2), GREEN, cv2.FILLED)
+		else:
+			cv2.rectangle(diff_mask, (x1, y1), (x2, y2), GREEN, cv2.FILLED)
+
 	if (write):
-		cv2.imwrite(f'{result_path}/original_mask.png', original_mask)
-		cv2.imwrite(f'{result_path}/diff_mask.png', diff_mask)
+		with tracing.span('write masks', 'diff'):
+			cv2.imwrite(f'{result_path}/original_mask.png', original_mask)
+			cv2.imwrite(f'{result_path}/diff_mask.png', diff_mask)
 	else:
 		cv2.imshow("Stock", original_mask)
 		cv2.imshow("Given", diff_mask)
 		cv2.waitKey(0)
 
+	return regions
+
+
+def region_hash(a, b, box, kind='changed'):
+	"""
+	Hash the before and after pixels of a region, so that the same change
+	showing up on many pages (like a changed site-wide header) hashes the
+	same on every one of them. Inserted content only has after pixels, and
+	removed content only has before pixels: the other image's pixels in the
+	same box are just whatever unrelated content got pushed up or down.
+	"""
+	(x1, y1, x2, y2) = box
+	h = hashlib.blake2b(digest_size=8)
+	h.update(kind.encode())
+	for img in { 'inserted': (b,), 'removed': (a,) }.get(kind, (a, b)):
+		crop = img[y1:y2, x1:x2]
+		h.update(str(crop.shape).encode())
+		h.update(np.ascontiguousarray(crop).data)
+	return h.hexdigest()
+
+
+def relative_origin(origin, box):
+	"""
+	A locate_origin result, with an origin box relative to the region's
+	own box, so that it also applies to the same change elsewhere on a page.
+	"""
+	if origin is None:
+		return origin
+	return [int(o - v) for (o, v) in zip(origin, box)]
+
+
+def absolute_origin(offsets, box):
+	if offsets is None:
+		return offsets
+	return [int(o + v) for (o, v) in zip(offsets, box)]
+
+
+def shrink(img, max_width, max_height=None):
+	"""
+	Scale an image down (never up) so that it fits the given size.
+	"""
+	(h, w) = img.shape[:2]
+	scale = min(1, max_width / w, (max_height or h) / h)
+	if scale == 1:
+		return img
+	size = (max(1, round(w * scale)), max(1, round(h * scale)))
+	return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+
+def crop_box(img, box, padding=CROP_PADDING):
+	"""
+	Crop a box (plus some context) out of an image, clipped to the image.
+	"""
+	(h, w) = img.shape[:2]
+	(x1, y1, x2, y2) = box
+	return img[max(0, y1 - padding):min(h, y2 + 1 + padding), max(0, x1 - padding):min(w, x2 + 1 + padding)]
+
+
+def write_thumbnails(a, b, regions, result_path):
+	"""
+	Write downscaled whole-page thumbnails for both images, and small
+	before/after crops for each highlighted region, so that a viewer can
+	show what changed without loading the full-page screenshots. Returns
+	an index of the files written, relative to the result path.
+	"""
+	cv2.imwrite(f'{result_path}/original_thumbnail.png', shrink(a, THUMBNAIL_WIDTH))
+	cv2.imwrite(f'{result_path}/thumbnail.png', shrink(b, THUMBNAIL_WIDTH))
+
+	crops = []
+	for (num, r) in enumerate(regions):
+		crop = { 'kind': r['kind'], 'box': r['box'] }
+
+		# relocated content was "before" at its origin, and removed content has no "after".
+		sides = [('before', a, r.get('origin', r['box']))]
+		if r['kind'] != 'removed':
+			sides.append(('after', b, r['box']))
+
+		for (side, img, box) in sides:
+			snippet = crop_box(img, box)
+			if snippet.size == 0:
+				continue
+			name = f'region-{num}-{side}.png'
+			cv2.imwrite(f'{result_path}/{name}', shrink(snippet, CROP_MAX_SIZE, CROP_MAX_SIZE))
+			crop[side] = name
+
+		crops.append(crop)
+
+	return {
+		'original': 'original_thumbnail.png',
+		'compare': 'thumbnail.png',
+		'crops': crops,
+	}
+
+
+def region(kind, box, origin=None):
+	"""
+	A highlighted region, as reported by highlight_diffs.
+	"""
+	r = { 'kind': kind, 'box': [int(v) for v in box] }
+	if origin is not None:
+		r['origin'] = [int(v) for v in origin]
+	return r
+
 
 def gray(img):
 	return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -228,34 +933,225 @@ def hue(img):
 	return cv2.cvtColor(img, cv2.COLOR_BGR2HSV)[:,:,0]
 
 
-def perform_diffing(image_pair, write=False, result_path='results', match_origin=True, max_passes=5, terse=False, silent=False):
+def diff_result(diffs=None, score=1.0, removed=None, regions=None):
+	"""
+	The structured result of diffing an image pair: the diff boxes as
+	[x1, y1, x2, y2] lists, the boxes for content that was removed from
+	the original (when aligning rows), the highlighted regions (see
+	highlight_diffs), the (gray/hue averaged) SSIM score, and whether
+	the pair counts as "the same".
+	"""
+	diffs = [] if diffs is None else diffs
+	removed = [] if removed is None else removed
+	return {
+		'passed': len(diffs) == 0 and len(removed) == 0,
+		'score': float(score),
+		'diffs': [[int(v) for v in d] for d in diffs],
+		'removed': [[int(v) for v in d] for d in removed],
+		'regions': [] if regions is None else regions,
+	}
 
-	if silent is True:
-		global SUPPRESS_LOGGING
-		SUPPRESS_LOGGING = True
 
-	(a, b) = image_pair
+def gray_and_hue(img):
+	"""
+	The gray and hue planes of an image, as a two channel image, so
+	that both can be compared in a single SSIM pass.
+	"""
+	return cv2.merge([gray(img), hue(img)])
 
-	log_info('Running grayscale comparison...')
-	grayDiff = compare("gray", gray(a), gray(b))
 
-	log_info('Running hue comparison...')
-	hueDiff = compare("hue", hue(a), hue(b))
+def diff_map(a, b, tile_height=0, planes_a=None):
+	"""
+	Run the gray and hue SSIM comparisons for a (same size) image pair,
+	returning the score and the combined diff map. The gray/hue planes
+	for a can be passed in, if they're already known.
+	"""
+	planes_a = gray_and_hue(a) if planes_a is None else planes_a
+	planes_b = gray_and_hue(b)
+
+	with tracing.span('ssim', 'diff', size=f'{a.shape[1]}x{a.shape[0]}') as span:
+		if tile_height > 0:
+			bands = dirty_bands(a, b, tile_height)
+			span['bands'] = len(bands)
+			log_info(f'{len(bands)} of {-(-a.shape[0] // tile_height)} bands changed.')
 
-	diff = cv2.addWeighted(grayDiff, 0.5, hueDiff, 0.5, 0)
+			log_info('Running tiled grayscale and hue comparison...')
+			scores, diffs = compare_tiled("gray+hue", planes_a, planes_b, bands)
+
+		else:
+			log_info('Running grayscale and hue comparison...')
+			scores, diffs = compare("gray+hue", planes_a, planes_b)
 
+	diff = cv2.addWeighted(diffs[:, :, 0], 0.5, diffs[:, :, 1], 0.5, 0)
+	score = float(np.mean(scores))
+	return score, diff
+
+
+def map_regions(diff):
+	"""
+	Turn a diff map into diff regions. Note that this modifies the diff map.
+	"""
 	log_info('Contrast-boosting diff...')
-	diff = cv2.cvtColor(diff, cv2.COLOR_GRAY2BGR)
-	diff[np.where((diff<[254,254,254]).all(axis=2))] = [0,0,0]
-	diff = cv2.cvtColor(diff, cv2.COLOR_BGR2GRAY)
+	diff[diff < 254] = 0
 
 	log_info('Extracting contours...')
-	diffs, tinydiffs = extract_contours(diff)
-	diffs.extend(tinydiffs)
+	with tracing.span('contours', 'diff') as span:
+		diffs, tinydiffs = extract_contours(diff)
+		diffs.extend(tinydiffs)
+		span['regions'] = len(diffs)
+	return diffs
+
+
+def diff_regions(a, b, tile_height=0, planes_a=None):
+	"""
+	Run the gray and hue SSIM comparisons for a (same size) image pair, and
+	turn the combined diff map into diff regions. Returns the score, and
+	the diff regions. The gray/hue planes for a can be passed in, if they're
+	already known.
+	"""
+	score, diff = diff_map(a, b, tile_height, planes_a)
+	return score, map_regions(diff)
+
+
+def gated_diffing(a, b, min_score, min_area, tile_height=0, planes_a=None):
+	"""
+	Only decide whether an image pair differs significantly, doing as little
+	work as possible: a pair fails as soon as its SSIM score is below the
+	minimum score, without looking for diff regions at all, and otherwise
+	fails if its diff regions cover at least the minimum area (in pixels).
+	There is no collapsing, relocation detection or highlighting.
+	"""
+	if a.shape != b.shape:
+		log_info('images differ in size, failing.')
+		return gate_result(False)
+
+	score, diff = diff_map(a, b, tile_height, planes_a)
+	if score < min_score:
+		log_info(f'score {score:.4f} is below {min_score}, failing.')
+		return gate_result(False, score)
+
+	diffs = map_regions(diff)
+	area = sum((x2 - x1) * (y2 - y1) for (x1, y1, x2, y2) in diffs)
+	log_info(f'found {len(diffs)} differences, covering {area}px.')
+	return gate_result(area < min_area, score, diffs)
+
+
+def gate_result(passed, score=0.0, diffs=None):
+	"""
+	A diff_result for gated diffing, where the pass/fail verdict does not
+	follow from whether there are any diff regions. As gating writes no
+	masks, its diff regions get reported as "diff" regions for the viewer.
+	"""
+	result = diff_result(diffs, score, regions=[region('diff', d) for d in (diffs or [])])
+	result['passed'] = passed
+	return result
+
+
+def aligned_diff_regions(a, b, tile_height=0, planes_a=None, rows_a=None):
+	"""
+	Align the rows of an image pair first, so that inserted and removed
+	content show up as a single region each, rather than as a difference
+	for everything below them. Only the blocks of rows that were changed,
+	rather than inserted or removed, get compared using SSIM. Returns the
+	score, the diff regions (in b), the removed regions (in a), and which of
+	the diff regions were inserted content. The gray/hue planes and row
+	hashes for a can be passed in, if they're already known.
+	"""
+	width = b.shape[1]
+	diffs = []
+	removed = []
+	inserted = []
+	dissimilarity = 0
+
+	with tracing.span('align', 'diff', size=f'{b.shape[1]}x{b.shape[0]}') as span:
+		opcodes = align_rows(a, b, rows_a)
+		span['blocks'] = len(opcodes)
+	log_info(f'aligned rows into {len(opcodes)} blocks.')
+
+	for (tag, i1, i2, j1, j2) in opcodes:
+		if tag == 'equal':
+			continue
+
+		if tag == 'insert':
+			diffs.append([0, j1, width, j2])
+			inserted.append(diffs[-1])
+			dissimilarity += j2 - j1
+			continue
+
+		if tag == 'delete':
+			removed.append([0, i1, width, i2])
+			dissimilarity += i2 - i1
+			continue
+
+		# a changed block: compare the part the two blocks have in
+		# common, and treat whatever is left over as inserted/removed.
+		height = min(i2 - i1, j2 - j1)
+		if height < SSIM_WINDOW:
+			diffs.append([0, j1, width, j2])
+			dissimilarity += max(i2 - i1, j2 - j1)
+			continue
+
+		block_planes = None if planes_a is None else planes_a[i1:i1 + height]
+		score, block_diffs = diff_regions(a[i1:i1 + height], b[j1:j1 + height], tile_height, block_planes)
+		diffs.extend([[x1, y1 + j1, x2, y2 + j1] for (x1, y1, x2, y2) in block_diffs])
+		dissimilarity += (1 - score) * height
+
+		if j2 - j1 > height:
+			diffs.append([0, j1 + height, width, j2])
+			inserted.append(diffs[-1])
+			dissimilarity += j2 - j1 - height
+		if i2 - i1 > height:
+			removed.append([0, i1 + height, width, i2])
+			dissimilarity += i2 - i1 - height
+
+	total = b.shape[0] + sum(r[3] - r[1] for r in removed)
+	return 1 - dissimilarity / total, diffs, removed, inserted
+
+
+def perform_diffing(image_pair, write=False, result_path='results', match_origin=True, max_passes=5, terse=False, silent=False, tile_height=0, align=False, search_band=0, original_planes=None, original_rows=None, masks=True, thumbnails=False, gate=None, known_regions=None):
+	"""
+	Diff an image pair, writing (or showing) the highlighted differences.
+	If the original's gray/hue planes (see gray_and_hue) and row hashes
+	(see row_hashes) are already known, these can be passed in too. When
+	writing without masks, the highlighted regions only end up in the result.
+	When writing thumbnails, the result lists them (see write_thumbnails).
+	When gating, with gate a (min_score, min_area) tuple, we only decide
+	whether the pair passes (see gated_diffing). When given the known
+	regions (see highlight_diffs), the result lists what we learned about
+	new regions as its "learned_regions".
+	"""
+
+	# diff workers are reused across pairs, so this has to be (re)set for every call.
+	global SUPPRESS_LOGGING
+	SUPPRESS_LOGGING = silent is True
+
+	(a, b) = image_pair
+
+	if a.shape == b.shape and np.array_equal(a, b):
+		# The common case: nothing changed, so there is no need to do any SSIM work.
+		if terse is True:
+			print('- no differences found.')
+		else:
+			log_info('images are pixel-identical, no differences found.')
+		return diff_result()
+
+	if gate is not None:
+		with tracing.span('gate', 'diff'):
+			result = gated_diffing(a, b, gate[0], gate[1], tile_height, original_planes)
+		if terse is True:
+			print('- no significant differences found.' if result['passed'] else '- differences found.')
+		return result
+
+	if align is True:
+		score, diffs, removed, inserted = aligned_diff_regions(a, b, tile_height, original_planes, original_rows)
+	else:
+		score, diffs = diff_regions(a, b, tile_height, original_planes)
+		(removed, inserted) = ([], [])
+
 	diff_count = len(diffs)
 	log_info(f'found {diff_count} differences.')
 
-	if diff_count > 0:
+	if diff_count > 0 or len(removed) > 0:
 		passes = 0
 		while match_origin and diff_count > 25 and passes < max_passes:
 			# This is too many diffs. See if we can merge a bunch of them
@@ -265,19 +1161,30 @@ def perform_diffing(image_pair, write=False, result_path='results', match_origin
 			passes += 1
 			log_info(f'too many diffs, attempting to collapse (pass {passes})...')
 			prev_count = diff_count
-			diffs = collapse_diffs(a, diffs)
+			with tracing.span('collapse', 'diff', regions=prev_count) as span:
+				diffs = collapse_diffs(b, diffs)
+				span['collapsed'] = len(diffs)
 			diff_count = len(diffs)
 			if diff_count == prev_count:
 				break
 		log_info(f'reduced to {len(diffs)} diffs')
 
 		log_info('Starting diff highlight...')
-		highlight_diffs(a, b, diffs, write, result_path, match_origin)
+		index = None if known_regions is None else dict(known_regions)
+		with tracing.span('highlight', 'diff', regions=len(diffs) + len(removed)):
+			regions = highlight_diffs(a, b, diffs, write, result_path, match_origin, removed, search_band, masks, index, inserted)
 
 		if terse is True:
 			print(f'- differences found.')
 
-		return diffs
+		result = diff_result(diffs, score, removed, regions)
+		if index is not None:
+			result['learned_regions'] = { k: v for (k, v) in index.items() if k not in known_regions }
+		if write is True and thumbnails is True:
+			with tracing.span('thumbnails', 'diff'):
+				result['thumbnails'] = write_thumbnails(a, b, regions, result_path)
+
+		return result
 
 	else:
 		if terse is True:
@@ -285,11 +1192,13 @@ def perform_diffing(image_pair, write=False, result_path='results', match_origin
 		else:
 			log_info('no differences found.')
 
+		return diff_result(score=score)
+
 
-def make_same_size(a, b):
+def make_same_size(a, b, same_height=True):
 	(h1, w1, c1) = a.shape
 	(h2, w2, c2) = b.shape
-	if h1 != h2:
+	if same_height and h1 != h2:
 		if h1 < h2:
 			b = b[0:h1, :]
 		else: